@@ -5,4 +5,4 @@ Created on Mon Feb 25 04:52:38 2019
 @author: yitzhak.sapir
 """
 
-__all__ = [ 'models', 'israel' ]
\ No newline at end of file
+__all__ = [ 'models', 'israel', 'summary', 'reports', 'sampling', 'diagnostics', 'service', 'cli' ]
\ No newline at end of file
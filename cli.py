@@ -0,0 +1,268 @@
+# coding: utf-8
+"""
+Command line entry point that runs the full forecast pipeline:
+
+    load datasets -> polls -> model -> sample -> seats -> summary -> reports
+
+The output of each stage is cached under a hash of its inputs and
+parameters, so a run that only changes, e.g., the reports skips sampling
+and the seat computations.
+
+Example usage:
+    python -m pyhoshen config.json --output-dir output --draws 2000
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+def compute_key(*parts):
+    """
+    Hash the given stage inputs: parameters, keys of earlier stages and
+    DataFrames.
+    """
+    import pandas as pd
+
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            digest.update(pd.util.hash_pandas_object(part, index=True).values.tobytes())
+            digest.update(json.dumps(list(map(str, part.columns))).encode('utf8'))
+        else:
+            digest.update(json.dumps(part, sort_keys=True, default=str).encode('utf8'))
+    return digest.hexdigest()[:20]
+
+class StageCache:
+    """
+    Stores the outputs of the pipeline stages as files named by their
+    stage and key.
+    """
+    def __init__(self, cache_dir, force=False):
+        self.cache_dir = cache_dir
+        self.force = force
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, stage, key, extension):
+        return os.path.join(self.cache_dir, '%s-%s.%s' % (stage, key, extension))
+
+    def load_arrays(self, stage, key):
+        path = self.path(stage, key, 'npz')
+        if self.force or not os.path.exists(path):
+            return None
+        with np.load(path) as arrays:
+            return { name: arrays[name] for name in arrays.files }
+
+    def save_arrays(self, stage, key, arrays):
+        # Write to a temporary file first so an interrupted run leaves no
+        # partial entry behind
+        path = self.path(stage, key, 'npz')
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **{ name: array for name, array in arrays.items() if array is not None })
+        os.replace(path + '.tmp', path)
+
+    def load_object(self, stage, key):
+        path = self.path(stage, key, 'pickle')
+        if self.force or not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save_object(self, stage, key, value):
+        path = self.path(stage, key, 'pickle')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+class ForecastPipeline:
+    """
+    The stages of a forecast run. Each stage computes its key from the key
+    of the stage before it and its own parameters, and only runs on a
+    cache miss. The model is built only when a stage that needs it runs.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.cache = StageCache(args.cache_dir, args.force)
+        self.election = None
+
+    def log(self, stage, key, cached):
+        print('%-8s %s %s' % (stage, key, 'cached' if cached else 'computed'))
+
+    def load(self):
+        from . import configuration
+
+        args = self.args
+        self.config = configuration.Configuration(args.config)
+        self.cycle = args.cycle if args.cycle is not None else max(self.config['cycles'])
+        cycle_config = self.config['cycles'][self.cycle]
+        for i, poll_config in enumerate(cycle_config['polls']):
+            self.config.read_polls(cycle_config, {'%s-%d' % (self.cycle, i): poll_config})
+        polls = self.config.dataframes['polls']
+        self.load_key = compute_key(self.config.config, *[ polls[name] for name in sorted(polls) ])
+        self.log('load', self.load_key, False)
+
+    def polls(self):
+        args = self.args
+        self.polls_key = compute_key(self.load_key, self.cycle, args.forecast_day,
+            args.extra_avg_days, args.max_poll_days, args.polls_since, args.min_poll_days)
+
+    def model(self):
+        # The model itself is built by get_election, when needed
+        args = self.args
+        self.model_key = compute_key(self.polls_key, args.house_effects_model, args.eta,
+            args.min_polls_per_pollster, args.adjacent_day_exponent)
+
+    def get_election(self):
+        if self.election is None:
+            from . import israel
+
+            args = self.args
+            self.election = israel.IsraeliElectionForecastModel(args.config,
+                forecast_election=self.cycle, forecast_day=args.forecast_day,
+                eta=args.eta, min_polls_per_pollster=args.min_polls_per_pollster,
+                house_effects_model=args.house_effects_model,
+                extra_avg_days=args.extra_avg_days, max_poll_days=args.max_poll_days,
+                polls_since=args.polls_since, min_poll_days=args.min_poll_days,
+                adjacent_day_fn=args.adjacent_day_exponent)
+            self.log('model', self.model_key, False)
+        return self.election
+
+    def sample(self):
+        args = self.args
+        self.sample_key = compute_key(self.model_key, args.draws, args.tune, args.chains,
+            args.adaptive, args.random_seed)
+        self.samples = self.cache.load_arrays('sample', self.sample_key)
+        self.log('sample', self.sample_key, self.samples is not None)
+        if self.samples is not None:
+            return
+
+        import pymc3 as pm
+        from . import sampling
+        from . import utils
+
+        election = self.get_election()
+        with election:
+            if args.adaptive:
+                sampler = sampling.AdaptiveSampler(election, chains=args.chains, tune=args.tune,
+                    max_draws=args.draws, random_seed=args.random_seed)
+                trace = sampler.sample()
+                report = sampler.report
+                print('adaptive %d of %d draws in %.0fs, %.0fs saved against sampling the chains in parallel' % (
+                    report['draws'], report['max_draws'], report['elapsed'], report['estimated_time_saved']))
+            else:
+                trace = pm.sample(args.draws, tune=args.tune, chains=args.chains,
+                    random_seed=args.random_seed)
+
+        dynamics = election.forecast_model.dynamics
+        house_effects = None
+        if hasattr(dynamics, 'pollster_house_effects_b'):
+            house_effects = trace[dynamics.pollster_house_effects_b.name]
+        self.samples = {
+            'party_ids': np.asarray(election.forecast_model.party_ids, dtype='str'),
+            'support': trace[election.support.name],
+            'house_effects': house_effects,
+            'correlation_matrices': utils.compute_correlations(
+                trace[election.forecast_model.cholesky_matrix.name]) }
+        self.cache.save_arrays('sample', self.sample_key, self.samples)
+
+    def seats(self):
+        args = self.args
+        self.seats_key = compute_key(self.sample_key, args.burn)
+        cached = self.cache.load_arrays('seats', self.seats_key)
+        self.log('seats', self.seats_key, cached is not None)
+        if cached is not None:
+            self.bader_ofer = cached['seats']
+            return
+
+        self.bader_ofer = self.get_election().compute_trace_bader_ofer(self.samples['support'][-args.burn:])
+        self.cache.save_arrays('seats', self.seats_key, { 'seats': self.bader_ofer })
+
+    def summary(self):
+        args = self.args
+        self.summary_key = compute_key(self.seats_key)
+        self.forecast_summary = self.cache.load_object('summary', self.summary_key)
+        self.log('summary', self.summary_key, self.forecast_summary is not None)
+        if self.forecast_summary is None:
+            from . import summary
+
+            self.forecast_summary = summary.ForecastSummary(self.samples['support'][-args.burn:],
+                self.bader_ofer)
+            self.cache.save_object('summary', self.summary_key, self.forecast_summary)
+
+        os.makedirs(args.output_dir, exist_ok=True)
+        self.forecast_summary.to_dataframe(self.samples['party_ids']).to_csv(
+            os.path.join(args.output_dir, 'summary.csv'), index=False)
+
+    def reports(self):
+        args = self.args
+        if args.reports == []:
+            return
+        # The number of processes only affects how the reports are rendered,
+        # not the reports themselves, so it is not part of the key. The output
+        # directory is, since the manifest lists the files written into it.
+        reports_key = compute_key(self.summary_key, args.reports, args.languages,
+            os.path.abspath(args.output_dir))
+        manifest = self.cache.load_object('reports', reports_key)
+        cached = manifest is not None and all(os.path.exists(filename) for filename in manifest)
+        self.log('reports', reports_key, cached)
+        if cached:
+            return
+
+        samples = self.samples
+        filenames = self.get_election().render_reports(args.output_dir,
+            samples['support'][-args.burn:], bader_ofer=self.bader_ofer,
+            house_effects=samples.get('house_effects'),
+            correlation_matrices=samples['correlation_matrices'],
+            burn=0, processes=args.processes, reports=args.reports, languages=args.languages,
+            forecast_summary=self.forecast_summary)
+        self.cache.save_object('reports', reports_key, filenames)
+
+    def run(self):
+        self.load()
+        self.polls()
+        self.model()
+        self.sample()
+        self.seats()
+        self.summary()
+        self.reports()
+
+def parse_args(argv=None):
+    def date(value):
+        return datetime.datetime.strptime(value, '%d/%m/%Y').date()
+
+    parser = argparse.ArgumentParser(description='Run the election forecast pipeline.')
+    parser.add_argument('config', help='the configuration file')
+    parser.add_argument('--cycle', help='the election cycle to forecast (default: the latest)')
+    parser.add_argument('--forecast-day', type=date, help='dd/mm/yyyy (default: election day)')
+    parser.add_argument('--polls-since', type=date, help='dd/mm/yyyy')
+    parser.add_argument('--extra-avg-days', type=int, default=0)
+    parser.add_argument('--max-poll-days', type=int)
+    parser.add_argument('--min-poll-days', type=int)
+    parser.add_argument('--house-effects-model', default='add-mean')
+    parser.add_argument('--eta', type=float, default=1)
+    parser.add_argument('--min-polls-per-pollster', type=int, default=1)
+    parser.add_argument('--adjacent-day-exponent', type=float, default=-2.)
+    parser.add_argument('--draws', type=int, default=1000)
+    parser.add_argument('--tune', type=int, default=1000)
+    parser.add_argument('--chains', type=int, default=4)
+    parser.add_argument('--adaptive', action='store_true',
+        help='stop sampling once converged, with --draws as the maximum. The chains are '
+             'sampled one after another rather than in parallel, so this may take longer '
+             'than the fixed budget when the chains converge late or there are many cores')
+    parser.add_argument('--random-seed', type=int)
+    parser.add_argument('--burn', type=int, default=1000,
+        help='the number of last samples used for the seats and reports')
+    parser.add_argument('--reports', nargs='*', help='the reports to render (default: all)')
+    parser.add_argument('--languages', nargs='*', help='the report languages (default: all)')
+    parser.add_argument('--processes', type=int, help='the number of report rendering processes')
+    parser.add_argument('--output-dir', default='output')
+    parser.add_argument('--cache-dir', default='.forecast-cache')
+    parser.add_argument('--force', action='store_true', help='ignore cached stage outputs')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    ForecastPipeline(parse_args(argv)).run()
@@ -0,0 +1,81 @@
+# coding: utf-8
+"""
+Leave-out diagnostics of a fitted forecast model, estimated from a
+single fit by Pareto-smoothed importance sampling (PSIS).
+"""
+
+import numpy as np
+
+class LeaveOutDiagnostics:
+    """
+    Estimates how the election-day support would change if a single poll,
+    or all the polls of a single pollster, were left out of the model,
+    without refitting it.
+
+    The pointwise log-likelihoods of the modeled polls are computed once
+    from the samples. Leaving polls out weights each sample by the inverse
+    of their likelihood, and the weights are Pareto-smoothed. Estimates
+    whose Pareto k exceeds 0.7 are not reliable, and require an actual
+    refit without those polls.
+
+    Example usage:
+        diagnostics = LeaveOutDiagnostics(election, samples)
+        print(diagnostics.leave_one_pollster_out())
+    """
+    def __init__(self, model, samples, day=0, reff=1.):
+        dynamics = model.forecast_model.dynamics
+        self.party_ids = model.forecast_model.party_ids
+        self.pollster_ids = model.forecast_model.pollster_ids
+        self.polls = dynamics.get_modeled_polls()
+        self.log_likelihood = dynamics.compute_trace_log_likelihood(samples)
+        self.reff = reff
+
+        support = np.asarray(samples[model.support.name])[:, day]
+        self.support = support / support.sum(axis=1, keepdims=True)
+        self.support_mean = self.support.mean(axis=0)
+
+    def estimate_support(self, log_likelihood):
+        """
+        Estimate the support with each group of polls left out, given the
+        nsamples x ngroups log-likelihood of each group. Returns the
+        ngroups x nparties estimates and the Pareto k of each group.
+        """
+        import arviz as az
+
+        log_weights, pareto_k = az.psislw(-log_likelihood.T, self.reff)
+        weights = np.exp(log_weights - log_weights.max(axis=1, keepdims=True))
+        weights /= weights.sum(axis=1, keepdims=True)
+        return weights @ self.support, np.asarray(pareto_k)
+
+    def create_table(self, index, support, pareto_k):
+        import pandas as pd
+
+        table = pd.DataFrame(support, index=index, columns=self.party_ids)
+        table['max_shift'] = np.abs(support - self.support_mean).max(axis=1)
+        table['pareto_k'] = pareto_k
+        return table
+
+    def leave_one_poll_out(self):
+        """
+        The support with each poll left out, the largest shift of any party
+        from the full posterior, and the Pareto k, as a table indexed by
+        the pollster and poll id.
+        """
+        import pandas as pd
+
+        support, pareto_k = self.estimate_support(self.log_likelihood)
+        index = pd.MultiIndex.from_tuples([ (self.pollster_ids[p.pollster_id], p.poll_id) for p in self.polls ],
+            names=['pollster', 'poll_id'])
+        return self.create_table(index, support, pareto_k)
+
+    def leave_one_pollster_out(self):
+        """
+        The support with all the polls of each pollster left out, the
+        largest shift of any party from the full posterior, and the Pareto
+        k, as a table indexed by the pollster.
+        """
+        poll_pollsters = np.asarray([ p.pollster_id for p in self.polls ])
+        pollsters = np.unique(poll_pollsters)
+        membership = (poll_pollsters[:, None] == pollsters[None, :]).astype(self.log_likelihood.dtype)
+        support, pareto_k = self.estimate_support(self.log_likelihood @ membership)
+        return self.create_table([ self.pollster_ids[p] for p in pollsters ], support, pareto_k)
@@ -5,6 +5,8 @@ Supporting analysis functions of Israeli Election results.
 
 from . import models
 from . import utils
+from . import summary
+from . import reports
 import theano
 import theano.tensor as tt
 from theano.ifelse import ifelse
@@ -15,9 +17,213 @@ import matplotlib.patheffects as pe
 import seaborn as sns
 import datetime
 
+# Seat counts never exceed the size of the Knesset, so the final allocations
+# are stored compactly. Intermediate computations use a signed type wide
+# enough for sums and differences of seat counts.
+SEATS_DTYPE = 'uint8'
+SEATS_COMPUTE_DTYPE = 'int16'
+SURPLUS_DTYPE = 'int8'
+
+# The number of seats in the Knesset
+KNESSET_SEATS = 120
+
 def strpdate(d):
     return datetime.datetime.strptime(d, '%d/%m/%Y').date()
 
+def create_surplus_matrix(num_parties, pairs):
+    """
+    Create the matrix that represents the given surplus agreement pairs
+    of party indices. The row of the first party of each pair sums both
+    parties, and the row of the second party is cleared.
+    """
+    surplus_matrix = np.eye(num_parties, dtype=SURPLUS_DTYPE)
+    pairs = np.asarray(pairs, dtype='int64').reshape(-1, 2)
+    surplus_matrix[pairs[:, 0], pairs[:, 1]] = 1
+    surplus_matrix[pairs[:, 1], pairs[:, 1]] = 0
+    return surplus_matrix
+
+def surplus_regimes_from_matrices(surplus_matrices, num_days):
+    """
+    Convert a single surplus matrix or a per-day stack of surplus
+    matrices into the (first_day, last_day, pairs) change-point
+    representation.
+    """
+    surplus_matrices = np.asarray(surplus_matrices)
+    if surplus_matrices.ndim == 2:
+        surplus_matrices = surplus_matrices[None]
+        change_points = np.array([0, num_days])
+    else:
+        changed = np.any(surplus_matrices[1:] != surplus_matrices[:-1], axis=(1, 2))
+        change_points = np.concatenate([[0], np.where(changed)[0] + 1, [num_days]])
+
+    off_diagonal = 1 - np.eye(surplus_matrices.shape[1], dtype=SURPLUS_DTYPE)
+    return [ (first_day, last_day, np.argwhere(surplus_matrices[first_day] * off_diagonal > 0))
+        for first_day, last_day in zip(change_points[:-1], change_points[1:]) ]
+
+def select_surplus_regimes(surplus_regimes, days):
+    """
+    Restrict (first_day, last_day, pairs) surplus regimes to the given
+    days, returning regimes indexed by position in the days list.
+    """
+    days = np.asarray(days)
+    first_days = np.array([ first_day for first_day, _, _ in surplus_regimes ])
+    regime_indices = np.searchsorted(first_days, days, side='right') - 1
+    
+    changed = regime_indices[1:] != regime_indices[:-1]
+    change_points = np.concatenate([[0], np.where(changed)[0] + 1, [len(days)]])
+    return [ (first, last, surplus_regimes[regime_indices[first]][2])
+        for first, last in zip(change_points[:-1], change_points[1:]) ]
+
+_bader_ofer_functions = {}
+
+def get_bader_ofer_function(float_type='float64', seats_dtype=SEATS_DTYPE):
+    """
+    Compile the theano function that computes the Bader-Ofer allocation
+    of a samples x days x parties array of initial seats and votes, with
+    the number of seats given per sample, under a single surplus matrix.
+    The function is compiled once per process for each float type of the
+    votes and dtype of the resulting seats.
+    """
+    key = (str(float_type), str(np.dtype(seats_dtype)))
+    if key in _bader_ofer_functions:
+        return _bader_ofer_functions[key]
+
+    def bader_ofer_fn___(prior, votes):
+        moded = votes / (prior + 1)
+        return prior + tt.eq(moded, moded.max())
+    
+    def bader_ofer_fn__(cur_seats, prior, votes, num_seats):
+        new_seats = ifelse(tt.lt(cur_seats, num_seats), bader_ofer_fn___(prior, votes), prior)
+        return (cur_seats + 1, new_seats.astype(SEATS_COMPUTE_DTYPE)), theano.scan_module.until(tt.ge(cur_seats, num_seats))
+    
+    # iterate a particular day of a sample, and compute the bader-ofer allocation
+    def bader_ofer_fn_(seats, votes, surplus_matrix, num_seats):
+      initial_seats = surplus_matrix.dot(seats)
+      comp_ejs__, upd_ejs__ = theano.scan(fn = bader_ofer_fn__,
+        outputs_info = [initial_seats.sum(), initial_seats], non_sequences = [surplus_matrix.dot(votes), num_seats], n_steps = num_seats)
+      joint_seats = comp_ejs__[1][-1]
+      surplus_t = surplus_matrix.T
+      has_seats_t = surplus_t * tt.gt(surplus_t.sum(0),1)
+      is_joint_t = tt.gt(surplus_t.sum(0),1).dot(surplus_matrix)
+      non_joint = tt.eq(is_joint_t, 0)
+      votes_t = votes.dimshuffle(0, 'x')
+      our_votes_t = surplus_t * votes_t
+      joint_moded = tt.switch(tt.eq(joint_seats, 0), 0, our_votes_t.sum(0) / joint_seats)
+      joint_moded_both_t = joint_moded * has_seats_t
+      initial_seats_t = tt.switch(tt.eq(joint_moded_both_t, 0), 0, our_votes_t // joint_moded_both_t)
+      moded_t = tt.switch(tt.eq(joint_moded_both_t, 0), 0, votes_t / (initial_seats_t + 1))
+      added_seats = tt.eq(moded_t, moded_t.max(0)) * has_seats_t * tt.gt(joint_seats - initial_seats_t, 0)
+      joint_added = initial_seats_t.sum(1) + added_seats.sum(1)
+      return (joint_seats * non_joint + joint_added * is_joint_t * (seats > 0)).astype(SEATS_COMPUTE_DTYPE)
+    
+    # iterate each day of a sample, and compute for each the bader-ofer allocation
+    def bader_ofer_fn(seats, votes, num_seats, surplus_matrix):
+      comp_bo_, _ = theano.scan(fn = bader_ofer_fn_, sequences=[seats, votes], non_sequences=[surplus_matrix, num_seats])
+      return comp_bo_
+    
+    votes = tt.tensor3("votes", dtype=key[0])
+    seats = tt.tensor3("seats", dtype=SEATS_COMPUTE_DTYPE)
+    num_seats = tt.vector("num_seats", dtype='int64')
+    surplus_matrix = tt.matrix("surplus_matrix", dtype=SURPLUS_DTYPE)
+    
+    # iterate each sample, and compute for each the bader-ofer allocation
+    comp_bo, _ = theano.scan(bader_ofer_fn, sequences=[seats, votes, num_seats], non_sequences=[surplus_matrix])
+    _bader_ofer_functions[key] = theano.function(inputs=[seats, votes, num_seats, surplus_matrix],
+                                                 outputs=comp_bo.astype(key[1]))
+    return _bader_ofer_functions[key]
+
+def normalize_votes(trace):
+    """
+    Normalize the support of a ... x days x parties trace to sum to 1.
+    """
+    return trace / trace.sum(axis=-1, keepdims=True)
+
+def get_seats_dtype(num_seats):
+    """
+    The dtype of the seat arrays for the given number (or numbers) of
+    seats: SEATS_DTYPE, or a wider unsigned type if it cannot hold them.
+    """
+    max_seats = int(np.max(num_seats))
+    assert max_seats <= np.iinfo(SEATS_COMPUTE_DTYPE).max, \
+        "expected at most %d seats, but was %d" % (np.iinfo(SEATS_COMPUTE_DTYPE).max, max_seats)
+    return np.promote_types(SEATS_DTYPE, np.min_scalar_type(max_seats))
+
+def compute_initial_seats(votes, threshold, num_seats=KNESSET_SEATS):
+    """
+    Remove the parties below the threshold from normalized votes of
+    a ... x days x parties trace, and compute the seats each party
+    receives before the remainders are allocated.
+    
+    threshold and num_seats may be arrays that broadcast against the
+    trace, e.g. to apply a different threshold to each sample.
+    """
+    passed_votes = np.where(votes < threshold, 0, votes)
+    
+    initial_moded = (passed_votes.sum(axis=-1, keepdims=True) / num_seats)
+    initial_seats = (passed_votes // initial_moded).astype(SEATS_COMPUTE_DTYPE)
+    return passed_votes, initial_seats
+
+def compute_bader_ofer(trace, surplus_regimes, threshold, num_seats=KNESSET_SEATS):
+    """
+    Compute the Bader-Ofer allocation of a samples x days x parties trace
+    of support, given surplus agreements as (first_day, last_day, pairs)
+    regimes. Each regime is computed once, over all of its days.
+    """
+    passed_votes, initial_seats = compute_initial_seats(normalize_votes(trace), threshold, num_seats)
+
+    num_samples, _, num_parties = trace.shape
+    seats_dtype = get_seats_dtype(num_seats)
+    bader_ofer_fn = get_bader_ofer_function(passed_votes.dtype, seats_dtype)
+    
+    bader_ofer = np.empty(trace.shape, dtype=seats_dtype)
+    for first_day, last_day, pairs in surplus_regimes:
+        bader_ofer[:, first_day:last_day] = bader_ofer_fn(
+            np.ascontiguousarray(initial_seats[:, first_day:last_day]),
+            np.ascontiguousarray(passed_votes[:, first_day:last_day]),
+            np.full(num_samples, num_seats, dtype='int64'),
+            create_surplus_matrix(num_parties, pairs))
+    return bader_ofer
+
+def _compute_bader_ofer_chunk(args):
+    return compute_bader_ofer(*args)
+
+def compute_grouped_bader_ofer(passed_votes, initial_seats, surplus_regimes, num_seats=None):
+    """
+    Compute the Bader-Ofer allocation of groups x samples x days x parties
+    votes and initial seats (as returned by compute_initial_seats), where
+    each group has its own list of surplus regimes and number of seats.
+    
+    The days are split at the change points of all groups, and within each
+    span the groups that share a surplus matrix are computed together.
+    """
+    num_groups, num_samples, num_days, num_parties = passed_votes.shape
+    if num_seats is None:
+        num_seats = KNESSET_SEATS
+    num_seats = np.broadcast_to(num_seats, [num_groups]).astype('int64')
+    seats_dtype = get_seats_dtype(num_seats)
+    bader_ofer_fn = get_bader_ofer_function(passed_votes.dtype, seats_dtype)
+
+    def regime_pairs(regimes, day):
+        return next(pairs for first_day, last_day, pairs in regimes if first_day <= day < last_day)
+
+    change_points = np.unique(np.concatenate([[num_days]] +
+        [[first_day for first_day, _, _ in regimes] for regimes in surplus_regimes]))
+
+    bader_ofer = np.empty(passed_votes.shape, dtype=seats_dtype)
+    for first_day, last_day in zip(change_points[:-1], change_points[1:]):
+        surplus_matrices = np.stack([ create_surplus_matrix(num_parties, regime_pairs(regimes, first_day))
+            for regimes in surplus_regimes ])
+        unique_matrices, matrix_groups = np.unique(surplus_matrices, axis=0, return_inverse=True)
+        for matrix_index, surplus_matrix in enumerate(unique_matrices):
+            groups = np.where(matrix_groups.reshape(-1) == matrix_index)[0]
+            shape = [len(groups) * num_samples, last_day - first_day, num_parties]
+            bader_ofer[groups, :, first_day:last_day] = bader_ofer_fn(
+                initial_seats[groups, :, first_day:last_day].reshape(shape),
+                passed_votes[groups, :, first_day:last_day].reshape(shape),
+                np.repeat(num_seats[groups], num_samples),
+                surplus_matrix).reshape([len(groups), num_samples, last_day - first_day, num_parties])
+    return bader_ofer
+
 class IsraeliElectionForecastModel(models.ElectionForecastModel):
     """
     A class that encapsulates computations specific to the Israeli Election
@@ -92,27 +298,54 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
         else:
             return '(According to “%s” House-Effects model)' % house_effects_model_name
         
+    def create_surplus_regimes(self, surplus_agreements=None, num_days=None):
+        """
+        Represent the surplus agreements between political parties as
+        change points: a list of (first_day, last_day, pairs) where the
+        pairs of party indices apply to days first_day <= day < last_day.
+        
+        Agreements only change on their 'since' dates, so there are only
+        a handful of regimes regardless of the number of days.
+        """
+        fe = self.forecast_model
+
+        if surplus_agreements is None:
+            surplus_agreements = fe.config['surplus_agreements']
+        if num_days is None:
+            num_days = fe.num_days
+
+        pairs = np.array([ [fe.party_ids.index(sa['name1']), fe.party_ids.index(sa['name2'])]
+            for sa in surplus_agreements ], dtype='int64').reshape(-1, 2)
+        
+        # An agreement applies from its 'since' date (if any) up until
+        # the forecast day, i.e. to days 0 through day_index(since).
+        last_days = np.array([ num_days if 'since' not in sa else self.day_index(sa['since']) + 1
+            for sa in surplus_agreements ], dtype='int64')
+        last_days = np.clip(last_days, 0, num_days)
+        
+        change_points = np.unique(np.concatenate([[0, num_days], last_days]))
+        return [ (first_day, last_day, pairs[last_days >= last_day])
+            for first_day, last_day in zip(change_points[:-1], change_points[1:]) ]
+
     def create_surplus_matrices(self):
         """
         Create matrices that represent the surplus agreements between
-        political parties, used during the Bader-Ofer computations.
+        political parties, one matrix per day.
+        
+        The Bader-Ofer computations use the compact representation
+        of create_surplus_regimes instead.
         """
         fe = self.forecast_model
 
         num_parties = len(fe.parties)
-        surplus_matrices = np.stack([ np.eye(num_parties, dtype="int64") ] * fe.num_days)
-        for day in range(fe.num_days):
-            cur_agreements = [ sa for sa in fe.config['surplus_agreements']
-                if 'since' not in sa or self.day_index(sa['since']) >= day ]
-            for agreement in cur_agreements:
-              party1 = fe.party_ids.index(agreement['name1'])
-              party2 = fe.party_ids.index(agreement['name2'])
-              surplus_matrices[day, party1, party2] = 1
-              surplus_matrices[day, party2, party2] = 0
+        surplus_matrices = np.empty([fe.num_days, num_parties, num_parties], dtype=SURPLUS_DTYPE)
+        for first_day, last_day, pairs in self.create_surplus_regimes():
+            surplus_matrices[first_day:last_day] = create_surplus_matrix(num_parties, pairs)
             
         return surplus_matrices
     
-    def compute_trace_bader_ofer(self, trace, surpluses = None, threshold = None):
+    def compute_trace_bader_ofer(self, trace, surpluses = None, threshold = None, num_seats = KNESSET_SEATS,
+                                 days = None):
         """
         Compute the Bader-Ofer on a full sample trace using theano scan.
         
@@ -120,105 +353,392 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
             bo=election.compute_trace_bader_ofer(samples['support'])
             
         trace should be of dimensions nsamples x ndays x nparties
+        
+        surpluses may be a list of surplus regimes as returned by
+        create_surplus_regimes, or a single or per-day stack of surplus
+        matrices.
+        
+        If days is given, only the seats of those days are computed, and
+        the result is of dimensions nsamples x len(days) x nparties.
+        """
+        trace, surpluses, threshold = self.prepare_trace_bader_ofer(trace, surpluses, threshold, days)
+        return compute_bader_ofer(trace, surpluses, threshold, num_seats)
+
+    def iterate_trace_bader_ofer(self, trace, chunk_size=1000, processes=None,
+                                 surpluses = None, threshold = None, num_seats = KNESSET_SEATS,
+                                 days = None):
         """
-        # trace : nsamples x ndays x nparties
-        num_seats = tt.constant(120)
-    
-        def bader_ofer_fn___(prior, votes):
-            moded = votes / (prior + 1)
-            return prior + tt.eq(moded, moded.max())
-        
-        def bader_ofer_fn__(cur_seats, prior, votes):
-            new_seats = ifelse(tt.lt(cur_seats, num_seats), bader_ofer_fn___(prior, votes), prior)
-            return (cur_seats + 1, new_seats.astype("int64")), theano.scan_module.until(tt.ge(cur_seats, num_seats))
-        
-        # iterate a particular day of a sample, and compute the bader-ofer allocation
-        def bader_ofer_fn_(seats, votes, surplus_matrix):
-          initial_seats = surplus_matrix.dot(seats)
-          comp_ejs__, upd_ejs__ = theano.scan(fn = bader_ofer_fn__,
-            outputs_info = [initial_seats.sum(), initial_seats], non_sequences = [surplus_matrix.dot(votes)], n_steps = num_seats)
-          joint_seats = comp_ejs__[1][-1]
-          surplus_t = surplus_matrix.T
-          has_seats_t = surplus_t * tt.gt(surplus_t.sum(0),1)
-          is_joint_t = tt.gt(surplus_t.sum(0),1).dot(surplus_matrix)
-          non_joint = tt.eq(is_joint_t, 0)
-          votes_t = votes.dimshuffle(0, 'x')
-          our_votes_t = surplus_t * votes_t
-          joint_moded = tt.switch(tt.eq(joint_seats, 0), 0, our_votes_t.sum(0) / joint_seats)
-          joint_moded_both_t = joint_moded * has_seats_t
-          initial_seats_t = tt.switch(tt.eq(joint_moded_both_t, 0), 0, our_votes_t // joint_moded_both_t)
-          moded_t = tt.switch(tt.eq(joint_moded_both_t, 0), 0, votes_t / (initial_seats_t + 1))
-          added_seats = tt.eq(moded_t, moded_t.max(0)) * has_seats_t * tt.gt(joint_seats - initial_seats_t, 0)
-          joint_added = initial_seats_t.sum(1) + added_seats.sum(1).astype("int64")
-          return joint_seats * non_joint + joint_added * is_joint_t * (seats > 0)
-        
-        # iterate each day of a sample, and compute for each the bader-ofer allocation
-        def bader_ofer_fn(seats, votes, surplus_matrices):
-          comp_bo_, _ = theano.scan(fn = bader_ofer_fn_, sequences=[seats, votes, surplus_matrices])
-          return comp_bo_
+        Compute the Bader-Ofer on a sample trace in chunks of chunk_size
+        samples, yielding the index of the first sample of each chunk and
+        its seats, so memory use does not depend on the number of samples.
         
+        If processes is given, the chunks are computed by a process pool,
+        with at most two chunks per process in flight at any time.
+        
+        Example usage:
+            for start, bo in election.iterate_trace_bader_ofer(samples['support'], processes=4):
+                ...
+        """
+        _, surpluses, threshold = self.prepare_trace_bader_ofer(trace[:0], surpluses, threshold, days)
+
+        def chunk_args(start):
+            chunk = np.asarray(trace[start:start + chunk_size], dtype=self.float_type)
+            if days is not None:
+                chunk = chunk[:, days]
+            return (chunk, surpluses, threshold, num_seats)
+
+        starts = range(0, len(trace), chunk_size)
+        if processes is None:
+            for start in starts:
+                yield start, _compute_bader_ofer_chunk(chunk_args(start))
+            return
+
+        import multiprocessing
+        import collections
+        
+        with multiprocessing.Pool(processes) as pool:
+            pending = collections.deque()
+            for start in starts:
+                pending.append((start, pool.apply_async(_compute_bader_ofer_chunk, (chunk_args(start),))))
+                if len(pending) >= 2 * processes:
+                    start, result = pending.popleft()
+                    yield start, result.get()
+            while len(pending) > 0:
+                start, result = pending.popleft()
+                yield start, result.get()
+
+    def prepare_trace_bader_ofer(self, trace, surpluses=None, threshold=None, days=None):
+        """
+        Resolve the default threshold and surplus regimes for a trace,
+        and restrict both the trace and the regimes to the given days.
+        The trace is converted to the float type of the model.
+        """
+        trace = np.asarray(trace, dtype=self.float_type)
         if threshold is None:
             threshold = float(self.forecast_model.config['threshold_percent']) / 100
 
         if surpluses is None:
-            surpluses = self.create_surplus_matrices()
-            
-        votes = tt.tensor3("votes")
-        seats = tt.tensor3("seats", dtype='int64')
-        surplus_matrices = tt.tensor3("surplus_matrices", dtype='int64')
+            surpluses = self.create_surplus_regimes(num_days=trace.shape[1])
+        elif isinstance(surpluses, np.ndarray):
+            surpluses = surplus_regimes_from_matrices(surpluses, trace.shape[1])
+
+        if days is not None:
+            days = np.atleast_1d(days)
+            trace = trace[:, days]
+            surpluses = select_surplus_regimes(surpluses, days)
+
+        return trace, surpluses, threshold
+
+    def compute_trace_bader_ofer_sweep(self, trace, thresholds, num_seats=None, surpluses=None):
+        """
+        Compute the Bader-Ofer on a full sample trace for a grid of thresholds
+        and, optionally, numbers of seats in one batch. The normalization of
+        the trace is shared by all of the grid.
         
-        # iterate each sample, and compute for each the bader-ofer allocation
-        comp_bo, _ = theano.scan(bader_ofer_fn, sequences=[seats, votes], non_sequences=[surplus_matrices])
-        compute_bader_ofer = theano.function(inputs=[seats, votes, surplus_matrices], outputs=comp_bo)
+        Example usage:
+            bo=election.compute_trace_bader_ofer_sweep(samples['support'],
+                [0.02, 0.025, 0.0325], num_seats=[120, 150])
         
-        kosher_votes = trace.sum(axis=2,keepdims=True)
+        Returns an array of num_seats x thresholds x samples x days x parties.
+        """
+        if num_seats is None:
+            num_seats = [ KNESSET_SEATS ]
+        thresholds = np.asarray(thresholds, dtype='float64')
+        num_seats = np.asarray(num_seats, dtype='int64')
+
+        trace, surpluses, _ = self.prepare_trace_bader_ofer(trace, surpluses)
+
+        grid_shape = [len(num_seats), len(thresholds)]
+        passed_votes, initial_seats = compute_initial_seats(normalize_votes(trace),
+            thresholds[None, :, None, None, None], num_seats[:, None, None, None, None])
+        passed_votes = np.broadcast_to(passed_votes, initial_seats.shape)
+
+        bader_ofer = compute_grouped_bader_ofer(
+            passed_votes.reshape([-1] + list(trace.shape)),
+            initial_seats.reshape([-1] + list(trace.shape)),
+            [ surpluses ] * np.prod(grid_shape),
+            np.repeat(num_seats, len(thresholds)))
+        return bader_ofer.reshape(grid_shape + list(trace.shape))
         
-        passed_votes = trace / kosher_votes
-        passed_votes[passed_votes < threshold] = 0
+    def create_scenario_transfer_matrix(self, scenario):
+        """
+        Create the parties x parties matrix that maps support to the
+        support under the given scenario (see compute_scenarios_bader_ofer).
+        Transfers are applied first, and then mergers.
+        """
+        fe = self.forecast_model
+        transfer_matrix = np.eye(fe.num_parties)
+
+        for from_party, to_party, fraction in scenario.get('transfers', []):
+            transfer = np.eye(fe.num_parties)
+            from_index = fe.party_ids.index(from_party)
+            transfer[from_index, from_index] -= fraction
+            transfer[from_index, fe.party_ids.index(to_party)] += fraction
+            transfer_matrix = transfer_matrix.dot(transfer)
+
+        for merger in scenario.get('mergers', []):
+            merger_indices = [ fe.party_ids.index(party) for party in merger ]
+            transfer = np.eye(fe.num_parties)
+            transfer[merger_indices, merger_indices] = 0
+            transfer[merger_indices, merger_indices[0]] = 1
+            transfer_matrix = transfer_matrix.dot(transfer)
         
-        initial_moded = (passed_votes.sum(axis=2, keepdims=True) / 120)
-        initial_seats = (passed_votes // initial_moded).astype('int64')
-    
-        ndays = trace.shape[1]
-        nparties = trace.shape[2]
+        return transfer_matrix
+
+    def create_scenario_surplus_regimes(self, scenario, num_days=None):
+        """
+        Create the surplus regimes of the given scenario (see
+        compute_scenarios_bader_ofer). Agreements of merged parties
+        pass to the party they were merged into.
         
-        if surpluses is None:
-            surpluses = self.create_surplus_matrices()
+        A party may only have a single agreement, so a ValueError is raised
+        if, e.g., both merged parties had agreements with other parties.
+        Such scenarios should drop the conflicting agreements.
+        """
+        fe = self.forecast_model
 
-        return compute_bader_ofer(initial_seats, passed_votes,
-            surpluses * np.ones([ndays, nparties, nparties], dtype='int64'))
+        surplus_agreements = scenario.get('surplus_agreements', fe.config['surplus_agreements'])
+        dropped = [ set(pair) for pair in scenario.get('drop_surplus_agreements', []) ]
+        surplus_agreements = [ sa for sa in surplus_agreements 
+            if set([sa['name1'], sa['name2']]) not in dropped ]
+        surplus_agreements += scenario.get('add_surplus_agreements', [])
         
-    def get_least_square_sum_seats(self, bader_ofer, day=0):
+        party_mapping = np.arange(fe.num_parties)
+        for merger in scenario.get('mergers', []):
+            merger_indices = [ fe.party_ids.index(party) for party in merger ]
+            party_mapping[np.isin(party_mapping, merger_indices)] = merger_indices[0]
+        
+        regimes = []
+        for first_day, last_day, pairs in self.create_surplus_regimes(surplus_agreements, num_days):
+            pairs = party_mapping[pairs]
+            pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+            # The same agreement may remain in both directions
+            _, unique_indices = np.unique(np.sort(pairs, axis=1), axis=0, return_index=True)
+            pairs = pairs[np.sort(unique_indices)]
+
+            num_agreements = np.bincount(pairs.reshape(-1), minlength=fe.num_parties)
+            if (num_agreements > 1).any():
+                conflicting = [ fe.party_ids[party] for party in np.where(num_agreements > 1)[0] ]
+                raise ValueError("parties %s would have more than one surplus agreement" %
+                    ', '.join(conflicting))
+            regimes += [ (first_day, last_day, pairs) ]
+        return regimes
+
+    def compute_scenarios_bader_ofer(self, trace, scenarios):
+        """
+        Compute the Bader-Ofer allocation of an existing trace of support
+        under each of a list of what-if scenarios, without re-running the
+        model. All scenarios are computed in one batch.
+        
+        Each scenario is a dict which may contain:
+            'transfers': a list of (from_party, to_party, fraction), moving
+                the given fraction of the support of from_party to to_party
+            'mergers': a list of lists of parties, the support of each list
+                is joined under its first party
+            'threshold': the threshold, as a fraction of the votes
+            'surplus_agreements': agreements replacing the configured ones
+            'drop_surplus_agreements': a list of (name1, name2) agreements to drop
+            'add_surplus_agreements': agreements to add
+        
+        Example usage:
+            bo=election.compute_scenarios_bader_ofer(samples['support'],
+                [{}, {'threshold': 0.025}, {'mergers': [['p1', 'p2']]}])
+        
+        Returns an array of scenarios x samples x days x parties.
+        """
+        default_threshold = float(self.forecast_model.config['threshold_percent']) / 100
+
+        trace = np.asarray(trace, dtype=self.float_type)
+        transfer_matrices = np.stack([ self.create_scenario_transfer_matrix(scenario)
+            for scenario in scenarios ]).astype(self.float_type)
+        thresholds = np.array([ scenario.get('threshold', default_threshold)
+            for scenario in scenarios ])
+        surplus_regimes = [ self.create_scenario_surplus_regimes(scenario, trace.shape[1])
+            for scenario in scenarios ]
+
+        scenario_trace = np.einsum('sdp,npq->nsdq', trace, transfer_matrices)
+        passed_votes, initial_seats = compute_initial_seats(
+            normalize_votes(scenario_trace), thresholds[:, None, None, None])
+        
+        return compute_grouped_bader_ofer(passed_votes, initial_seats, surplus_regimes)
+
+    def get_least_square_sum_seats(self, bader_ofer, day=0, chunk_size=1000,
+                                   num_reference_samples=None, random_seed=None):
         """
         Determine the sample whose average distance in seats to the other samples
         is most minimal, distance computed as the square root of sum of squares
         of the seats of the parties.
+
+        See utils.compute_medoid_index for the chunking and the approximate
+        mode using num_reference_samples.
         """
-        bo_plot = bader_ofer.transpose(1,2,0)[day]
-        bo_sqrsum = np.sqrt(np.sum((bo_plot[:,:,None] - bo_plot[:,None,:]) ** 2, axis=0)).mean(axis=0)
-        return bader_ofer[bo_sqrsum.argmin()][day]
+        medoid = utils.compute_medoid_index(bader_ofer[:, day], chunk_size,
+            num_reference_samples, random_seed)
+        return bader_ofer[medoid][day]
     
-    def compute_interval(self, values, alpha=0.95):    
+    def compute_interval(self, values, alpha=0.95, method='normal'):    
+        if method != 'normal':
+            return tuple(utils.compute_intervals(values, alpha, method))
+
         avg = values.mean()
         scale = values.std()
         
         return ss.norm.interval(alpha, avg, scale)
 
-    def compute_mandates_interval(self, mandates, alpha=0.95):    
+    def compute_mandates_interval(self, mandates, alpha=0.95, num_seats=KNESSET_SEATS, method='normal'):    
+        return self.round_mandates_interval(self.compute_interval(mandates, alpha, method), num_seats)
+
+    def compute_seats_intervals(self, bader_ofer, alpha=0.95, method='empirical', coalitions=None):
+        """
+        Compute the seat intervals of all parties on all days in one pass
+        over the trace, using utils.compute_intervals. Returns an array of
+        2 x ndays x nparties holding the lower and upper bounds.
+        
+        If coalitions are given (as in the 'coalitions' configuration), the
+        intervals of the coalitions are returned as well, as an array of
+        2 x ndays x ncoalitions.
+        """
+        intervals = utils.compute_intervals(bader_ofer, alpha, method)
+        if coalitions is None:
+            return intervals
+
+        coalitions_matrix = self.create_coalitions_matrix(coalitions)
+        coalitions_bo = bader_ofer.astype(SEATS_COMPUTE_DTYPE).dot(coalitions_matrix.T.astype(SEATS_COMPUTE_DTYPE))
+        return intervals, utils.compute_intervals(coalitions_bo, alpha, method)
+
+    def create_coalitions_matrix(self, coalitions=None):
+        """
+        Create the ncoalitions x nparties membership matrix of the given
+        coalitions (by default, the 'coalitions' configuration).
+        """
+        fe = self.forecast_model
+
+        if coalitions is None:
+          coalitions = fe.config['coalitions']
+
+        coalitions_matrix = np.zeros([len(coalitions), fe.num_parties], dtype='bool')
+        for i, (coalition, config) in enumerate(coalitions.items()):
+           for party in config['parties']:
+              party_index = fe.party_ids.index(party)
+              coalitions_matrix[i][party_index] = 1
+        return coalitions_matrix
+
+    def round_mandates_interval(self, interval, num_seats=KNESSET_SEATS):
         threshold = float(self.forecast_model.config['threshold_percent']) / 100
 
         def convert_interval(i):
-          if i < int(threshold * 120):
+          if i < int(threshold * num_seats):
             return 0
           else:
             return np.round(i)
         
-        return tuple(convert_interval(i) for i in self.compute_interval(mandates, alpha))
+        return tuple(convert_interval(i) for i in interval)
+
+    def create_forecast_summary(self, support, bader_ofer=None, burn=None, **kwargs):
+        """
+        Create the summary shared by the reports from a trace of support
+        and, if already computed, its Bader-Ofer seats. The last burn samples
+        are used, as in plot_party_support_evolution_graphs.
+        """
+        if burn is not None:
+            support = support[burn:]
+            if bader_ofer is not None:
+                bader_ofer = bader_ofer[burn:]
+        if bader_ofer is None:
+            bader_ofer = self.compute_trace_bader_ofer(support)
+        return summary.ForecastSummary(support, bader_ofer, **kwargs)
       
-    def plot_mandates(self, bader_ofer, max_bo=None, day=0, hebrew=True):
+    def compute_coalition_probabilities(self, bader_ofer, min_mandates=(61, 65),
+                                        parties=None, max_coalition_parties=None,
+                                        days=None, max_elements=2 ** 26):
+        """
+        Compute the probability of every combination of the given parties
+        reaching each number of seats in min_mandates, on each of the days.
+
+        By default all parties that win seats in any sample are combined,
+        on all the days of the trace; pass days=[0] for election day only.
+        Coalitions are the rows of a bitmask matrix, and the seats of all
+        coalitions are computed for all samples of each day by matrix
+        products, in chunks of at most max_elements seat totals, so only
+        the probabilities grow with the days and the coalitions.
+
+        Returns the party indices, the coalitions x parties bitmask matrix
+        and the probabilities as a min_mandates x days x coalitions float32
+        array.
+        """
+        if days is None:
+            days = np.arange(bader_ofer.shape[1])
+        days = np.atleast_1d(days)
+        min_mandates = np.atleast_1d(min_mandates)
+
+        if parties is None:
+            parties = np.where(bader_ofer[:, days].max(axis=(0, 1)) > 0)[0]
+        parties = np.asarray(parties)
+        num_parties = len(parties)
+
+        codes = np.arange(1, 2 ** num_parties, dtype='int64')
+        coalitions_matrix = ((codes[:, None] >> np.arange(num_parties)) & 1).astype('bool')
+        if max_coalition_parties is not None:
+            coalitions_matrix = coalitions_matrix[coalitions_matrix.sum(axis=1) <= max_coalition_parties]
+        num_coalitions = len(coalitions_matrix)
+
+        # Seat counts are small integers, so float32 products are exact.
+        num_samples = bader_ofer.shape[0]
+        chunk_size = max(1, max_elements // num_samples)
+
+        probabilities = np.empty([len(min_mandates), len(days), num_coalitions], dtype='float32')
+        for day_index, day in enumerate(days):
+            bo = bader_ofer[:, day, parties].astype('float32')
+            for start in range(0, num_coalitions, chunk_size):
+                chunk = coalitions_matrix[start:start + chunk_size].astype('float32')
+                coalitions_bo = bo.dot(chunk.T)
+                for mandates_index, mandates in enumerate(min_mandates):
+                    probabilities[mandates_index, day_index, start:start + chunk_size] = (
+                        coalitions_bo >= mandates).mean(axis=0)
+
+        return parties, coalitions_matrix, probabilities
+
+    def rank_coalitions(self, bader_ofer, day=0, min_mandates_for_coalition=61,
+                        stable_mandates_for_coalition=65, top=50, hebrew=False, **kwargs):
+        """
+        Rank all combinations of parties by their probability of reaching
+        min_mandates_for_coalition seats on the given day. Ties are ranked
+        by the probability of a stable coalition and then by fewer parties.
+
+        Additional arguments are passed to compute_coalition_probabilities.
+        """
+        import pandas as pd
+        from bidi import algorithm as bidialg
+
+        fe = self.forecast_model
+
+        parties, coalitions_matrix, probabilities = self.compute_coalition_probabilities(
+            bader_ofer, min_mandates=(min_mandates_for_coalition, stable_mandates_for_coalition),
+            days=[day], **kwargs)
+        minimum, stable = probabilities[:, 0]
+        num_coalition_parties = coalitions_matrix.sum(axis=1)
+        mean_mandates = coalitions_matrix.dot(bader_ofer[:, day][:, parties].mean(axis=0))
+
+        ranking = np.lexsort((num_coalition_parties, -stable, -minimum))[:top]
+
+        party_names = np.array([ bidialg.get_display(fe.parties[fe.party_ids[p]]['hname']) if hebrew
+            else fe.parties[fe.party_ids[p]]['name'] for p in parties ], dtype='object')
+        return pd.DataFrame({
+            'parties': [ ', '.join(party_names[coalition]) for coalition in coalitions_matrix[ranking] ],
+            'num_parties': num_coalition_parties[ranking],
+            'mean_mandates': mean_mandates[ranking],
+            '%d_and_above' % min_mandates_for_coalition: minimum[ranking],
+            '%d_and_above' % stable_mandates_for_coalition: stable[ranking] })
+
+    def plot_mandates(self, bader_ofer=None, max_bo=None, day=0, hebrew=True, forecast_summary=None,
+                      interval_method='normal'):
         """
         Plot the resulting mandates of the parties and their distributions.
         This is the bar graph most often seen in poll results.
+        
+        The statistics are taken from forecast_summary if given, and
+        otherwise computed from bader_ofer. interval_method is 'normal',
+        'empirical' or 'hdi' (see utils.compute_intervals).
         """
         
         from bidi import algorithm as bidialg
@@ -226,10 +746,20 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
         fe=self.forecast_model
         parties = fe.parties
     
-        bo_plot = bader_ofer.transpose(1,2,0)[day]
+        if forecast_summary is None:
+            forecast_summary = summary.ForecastSummary(None, bader_ofer)
+        num_samples = forecast_summary.num_samples
+
+        def mandates_interval(party):
+            if interval_method == 'normal':
+                interval = ss.norm.interval(0.95,
+                    forecast_summary.seats_mean[day, party], forecast_summary.seats_std[day, party])
+            else:
+                interval = forecast_summary.seats_intervals(0.95, interval_method)[:, day, party]
+            return self.round_mandates_interval(interval)
     
         if max_bo is None:
-            max_bo = self.get_least_square_sum_seats(bader_ofer, day)
+            max_bo = forecast_summary.representative_seats(day)
 
         num_passed_parties = len(np.where(max_bo > 0)[0])
         passed_parties = max_bo.argsort()[::-1]
@@ -241,12 +771,12 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
           party = passed_parties[i]
           name = bidialg.get_display(parties[fe.party_ids[party]]['hname']) if hebrew else parties[fe.party_ids[party]]['name']
           plots[0][i].set_title(name, va='bottom', y=-0.08, fontsize='large')
-          mandates_count = np.unique(bo_plot[party], return_counts=True)
+          mandates_count = forecast_summary.seats_distribution(day, party)
           mandates_bar = plots[0][i].bar([0], [max_bo[party]])[0] #, tick_label=[name])
           plots[0][i].set_xlim(-0.65,0.65)
           plots[0][i].text(mandates_bar.get_x() + mandates_bar.get_width()/2.0, mandates_bar.get_height(), '%d' % max_bo[party], ha='center', va='bottom', fontsize='x-large')
           plots[0][i].set_ylim(top=max_bo_height)
-          bars = plots[1][i].bar(mandates_count[0], 100 * mandates_count[1] / len(bo_plot[party]))
+          bars = plots[1][i].bar(mandates_count[0], 100 * mandates_count[1] / num_samples)
           xticks = []
           xtick_labels = []
           max_start = 0
@@ -256,9 +786,9 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
             max_start = 1
             zero_rect = bars[0]
             zero_rect.set_color('red')
-            plots[1][i].text(zero_rect.get_x() + zero_rect.get_width()/2.0, zero_rect.get_height(), ' %d%%' % (100 * mandates_count[1][0] / len(bo_plot[party])), ha='center', va='bottom')
+            plots[1][i].text(zero_rect.get_x() + zero_rect.get_width()/2.0, zero_rect.get_height(), ' %d%%' % (100 * mandates_count[1][0] / num_samples), ha='center', va='bottom')
           if len(mandates_count[1]) > max_start:
-              interval = self.compute_mandates_interval(bo_plot[party])
+              interval = mandates_interval(party)
               max_index = max_start + np.argmax(mandates_count[1][max_start:])
               max_rect = bars[max_index]
               #plots[1][i].text(max_rect.get_x() + max_rect.get_width()/2.0, max_rect.get_height(), ' %d%%' % (100 * mandates_count[1][max_index] / len(bo_plot[party])), ha='center', va='bottom')
@@ -281,7 +811,7 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
           xlim_center = (xlim[0] + xlim[1]) / 2
           plots[1][i].set_xlim(xlim_center - xlim_side, xlim_center + xlim_side)
           plots[1][i].set_ylim(top=max(ylim_height))
-        bo_mean = bo_plot.mean(axis=1)
+        bo_mean = forecast_summary.seats_mean[day]
         failed_parties = [ i for i in bo_mean.argsort()[::-1] if max_bo[i] == 0 ]
         num_failed_parties = len(failed_parties)
         offset = num_passed_parties // 3
@@ -290,20 +820,20 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
             failed_plot = fig.add_subplot(num_failed_parties*2, num_passed_parties,
                 num_passed_parties * (failed_index + 1) - offset, ymargin = 1)
             party = failed_parties[failed_index]
-            mandates_count = np.unique(bo_plot[party], return_counts=True)
+            mandates_count = forecast_summary.seats_distribution(day, party)
             if len(mandates_count[0]) > 1:
                 max_start = 0
                 xticks = []
                 xtick_labels = []
-                bars = failed_plot.bar(mandates_count[0], 100 * mandates_count[1] / len(bo_plot[party]))
+                bars = failed_plot.bar(mandates_count[0], 100 * mandates_count[1] / num_samples)
                 if 0 in mandates_count[0]:
                     #xticks += [0]
                     max_start = 1
                     zero_rect = bars[0]
                     zero_rect.set_color('red')
-                    failed_plot.text(zero_rect.get_x() + zero_rect.get_width()/2.0, zero_rect.get_height(), ' %d%%' % (100 * mandates_count[1][0] / len(bo_plot[party])), ha='center', va='bottom')
+                    failed_plot.text(zero_rect.get_x() + zero_rect.get_width()/2.0, zero_rect.get_height(), ' %d%%' % (100 * mandates_count[1][0] / num_samples), ha='center', va='bottom')
                 if len(mandates_count[1]) > max_start:
-                    interval = self.compute_mandates_interval(bo_plot[party])
+                    interval = mandates_interval(party)
                     max_index = max_start + np.argmax(mandates_count[1][max_start:])
                     max_rect = bars[max_index]
                     #failed_plot.text(max_rect.get_x() + max_rect.get_width()/2.0, max_rect.get_height(), ' %d%%' % (100 * mandates_count[1][max_index] / len(bo_plot[party])), ha='center', va='bottom')
@@ -337,9 +867,13 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
             fig.text(.5, 1., self.house_effects_model_title(hebrew), ha='center', fontsize='small')
         fig.figimage(self.create_logo(), fig.bbox.xmax / 2 + 100, fig.bbox.ymax - 100, zorder=1000)
 
-    def plot_coalitions(self, bader_ofer, coalitions=None, day=0, min_mandates_for_coalition=61, stable_mandates_for_coalition=65, hebrew=True):
+    def plot_coalitions(self, bader_ofer=None, coalitions=None, day=0, min_mandates_for_coalition=61, stable_mandates_for_coalition=65, hebrew=True,
+                        forecast_summary=None):
         """
         Plot the resulting mandates of the coalitions and their distributions.
+        
+        The seats are taken from forecast_summary if given, and otherwise
+        from bader_ofer.
         """
     
         from bidi import algorithm as bidialg
@@ -350,14 +884,11 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
           coalitions = fe.config['coalitions']
     
         num_coalitions = len(coalitions)
-        coalitions_matrix = np.zeros([num_coalitions, fe.num_parties], dtype='bool')
-        for i, (coalition, config) in enumerate(coalitions.items()):
-           for party in config['parties']:
-              party_index = fe.party_ids.index(party)
-              coalitions_matrix[i][party_index] = 1
+        coalitions_matrix = self.create_coalitions_matrix(coalitions)
     
-        bo_plot = bader_ofer.transpose(1,2,0)[day]
-        coalitions_bo = coalitions_matrix.dot(bo_plot)
+        if forecast_summary is not None:
+            bader_ofer = forecast_summary.seats
+        coalitions_bo = coalitions_matrix.astype(SEATS_COMPUTE_DTYPE).dot(bader_ofer[:, day].T.astype(SEATS_COMPUTE_DTYPE))
     
         fig, plots = plt.subplots(1, num_coalitions, figsize=(5 * num_coalitions, 5))
         xlim_dists = []
@@ -450,6 +981,9 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
         house_effects = samples.transpose(2,1,0)
         fe = self.forecast_model
         
+        # The densities of all pollsters and parties are computed in one call
+        _, _, grids, densities = utils.compute_binned_densities(100 * house_effects)
+        
         actual_pollsters = [i for i in fe.dynamics.pollster_mapping.items() if i[1] is not None]
         pollster_ids = [fe.pollster_ids[pollster] for _,pollster in sorted(actual_pollsters, key=lambda i: i[1])]
 
@@ -477,8 +1011,9 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
                 col.align="right" 
           ax.set_title(bidialg.get_display(fe.parties[party]['hname']) if hebrew 
                        else fe.parties[party]['name'])
-          for pi, pollster_house_effects in enumerate(house_effects[i]):
-            sns.kdeplot(100 * pollster_house_effects, shade=True, ax=ax, color=cpalette[pi])
+          for pi in range(len(house_effects[i])):
+            ax.fill_between(grids[i][pi], densities[i][pi], color=cpalette[pi], alpha=0.25)
+            ax.plot(grids[i][pi], densities[i][pi], color=cpalette[pi])
           ax.xaxis.set_major_formatter(ticker.PercentFormatter(decimals=1))
           ax.yaxis.set_major_formatter(ticker.PercentFormatter(decimals=1))
           plots += [ax]
@@ -486,9 +1021,42 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
                  ha='center', fontsize='xx-large')
         fig.text(.5, .05, 'Generated using pyHoshen © 2019', ha='center')
 
-    def plot_party_support_evolution_graphs(self, samples, mbo = None, burn=None, hebrew = True):
+    def prepare_support_evolution(self, samples = None, mbo = None, burn=None, forecast_summary = None,
+                                  threshold = None, z=1.95996):
+        """
+        Prepare the per-day series of the support evolution graphs as a
+        summary.SupportEvolution, which may also be exported as a table,
+        e.g. for a web front-end.
+        
+        The statistics are taken from forecast_summary if given, and
+        otherwise computed from the last burn samples and mbo.
+        
+        Example usage:
+            election.prepare_support_evolution(samples['support']).to_dataframe(
+                election.forecast_model.party_ids).to_csv('evolution.csv')
+        """
+        if forecast_summary is None:
+            if burn is None:
+                burn = -min(len(samples), 1000)
+            forecast_summary = self.create_forecast_summary(samples, mbo, burn)
+        
+        fe = self.forecast_model
+        if threshold is None:
+            threshold = float(fe.config['threshold_percent']) / 100
+        
+        dates = np.datetime64(fe.forecast_day, 'D') - np.arange(fe.num_days)
+        party_configs = [ fe.config['parties'][party_id] for party_id in fe.party_ids ]
+        created_days = [ self.day_index(party_config['created']) if 'created' in party_config
+            else fe.num_days for party_config in party_configs ]
+        return summary.SupportEvolution(forecast_summary, dates, threshold, created_days, z)
+
+    def plot_party_support_evolution_graphs(self, samples = None, mbo = None, burn=None, hebrew = True,
+                                            forecast_summary = None, evolution = None):
         """
         Plot the evolving support of each party over time in both percentage and seats.
+        
+        The series are taken from evolution if given, and otherwise
+        prepared by prepare_support_evolution.
         """
         import matplotlib.pyplot as plt
         import matplotlib.ticker as ticker
@@ -502,35 +1070,21 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
             else:
                 return 1 + n // divisor, divisor
      
-        if burn is None:
-            burn = -min(len(samples), 1000)
-            
-        if mbo is None:
-            mbo = self.compute_trace_bader_ofer(samples)
-    
-        samples = samples[burn:]
-        mbo = mbo[burn:]
+        if evolution is None:
+            evolution = self.prepare_support_evolution(samples, mbo, burn, forecast_summary)
         
         fe = self.forecast_model
                 
-        mbo_by_party = np.transpose(mbo, [2, 1, 0])
-        mandates = 0
-        mbo_by_day_party = np.transpose(mbo, [1, 2, 0])
-        party_avg = mbo_by_day_party[0].mean(axis=1).argsort()[::-1]
-        date_list = [fe.forecast_day - datetime.timedelta(days=x) for x in range(0, fe.num_days)]
+        date_list = evolution.dates
+        date_ticks = date_list[::7]
         dimensions = get_dimensions(fe.num_parties)
         fig, plots = plt.subplots(dimensions[1], dimensions[0], 
                                   figsize=(5.5 * dimensions[0], 3.5 * dimensions[1]))
-        means = samples.mean(axis=0)
-        stds = samples.std(axis=0)
     
-        for index, party in enumerate(party_avg):
+        for index, party in enumerate(evolution.party_order):
             party_config = fe.config['parties'][fe.party_ids[party]]
-            
-            if 'created' in party_config:
-                days_to_show = (fe.forecast_day - strpdate(party_config['created'])).days
-            else:
-                days_to_show = fe.num_days
+            active = evolution.active[:, party]
+            party_dates = date_list[active]
 
             vindex = index // dimensions[0]
             hindex = index % dimensions[0]
@@ -545,9 +1099,6 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
     
             subplot = subplots[hindex].twinx()
     
-            num_day_ticks = fe.num_days
-            date_ticks = [fe.forecast_day - datetime.timedelta(days=x) 
-                for x in range(0, num_day_ticks, 7)]
             subplots[hindex].set_xticks(date_ticks)
             subplots[hindex].set_xticklabels(subplots[hindex].get_xticklabels(), rotation=45)
             subplots[hindex].set_xlim(date_list[-1], date_list[0])
@@ -555,28 +1106,23 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
             subplot.set_xticklabels(subplot.get_xticklabels(), rotation=45)
             subplot.set_xlim(date_list[-1], date_list[0])
     
-            party_means = means[:, party]
-            party_std = stds[:, party]
-            
-            subplots[hindex].fill_between(date_list[:days_to_show],
-                    100*party_means[:days_to_show] - 100*1.95996*party_std[:days_to_show],
-                    100*party_means[:days_to_show] + 100*1.95996*party_std[:days_to_show],
+            subplots[hindex].fill_between(party_dates,
+                    100*evolution.support_lower[active, party],
+                    100*evolution.support_upper[active, party],
                     color='#90ee90')
-            subplots[hindex].plot(date_list[:days_to_show],
-                    100*party_means[:days_to_show], color='#32cd32')
+            subplots[hindex].plot(party_dates,
+                    100*evolution.support_mean[active, party], color='#32cd32')
             if subplots[hindex].get_ylim()[0] < 0:
                 subplots[hindex].set_ylim(bottom=0)
             subplots[hindex].yaxis.set_major_formatter(ticker.PercentFormatter(decimals=1))
             subplots[hindex].tick_params(axis='y', colors='#32cd32')
             subplots[hindex].yaxis.label.set_color('#32cd32')
                 
-            mand_means = np.mean(mbo_by_party[party], axis=1)
-            mand_std = np.std(mbo_by_party[party], axis=1)
-            subplot.fill_between(date_list[:days_to_show],
-                    mand_means[:days_to_show] - 1.95996*mand_std[:days_to_show], 
-                    mand_means[:days_to_show] + 1.95996*mand_std[:days_to_show], 
+            subplot.fill_between(party_dates,
+                    evolution.seats_lower[active, party],
+                    evolution.seats_upper[active, party],
                     alpha=0.5, color='#6495ed')
-            subplot.plot(date_list[:days_to_show], mand_means[:days_to_show], color='#4169e1')
+            subplot.plot(party_dates, evolution.seats_mean[active, party], color='#4169e1')
             if subplot.get_ylim()[0] < 0:
                 subplot.set_ylim(bottom=0)
             if subplot.get_ylim()[1] < 4:
@@ -602,15 +1148,12 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
      
             subplots[hindex].grid(False)           
             
-            sup = [sample[party][0] for sample in samples]
-            mandates += int(120.0*sum(sup)/len(samples))
-            
             subplots[hindex].xaxis.set_major_formatter(mdates.DateFormatter('%d/%m'))
             
             subplots[hindex].set_xlim(date_ticks[-1], date_ticks[0])
             subplot.set_xlim(date_ticks[-1], date_ticks[0])
     
-        for empty_subplot in range(len(party_avg), np.product(dimensions)):
+        for empty_subplot in range(len(evolution.party_order), np.product(dimensions)):
             hindex = empty_subplot % dimensions[0]
             if hebrew:
                 hindex = -hindex - 1 # work right to left in hebrew
@@ -628,6 +1171,42 @@ class IsraeliElectionForecastModel(models.ElectionForecastModel):
 
         fig.figimage(self.create_logo(), fig.bbox.xmax / 2 + 100, fig.bbox.ymax - 100, zorder=1000)
 
+    def render_reports(self, output_dir, support, bader_ofer=None, house_effects=None,
+                       correlation_matrices=None, burn=None, processes=None,
+                       reports=None, languages=None, options=None, forecast_summary=None):
+        """
+        Render the full report set as PNG images in both English and Hebrew,
+        running the plots in a process pool with the Agg backend.
+        
+        The seats and support reports are drawn from forecast_summary if
+        given, and otherwise from a summary of the last burn samples of
+        support and bader_ofer.
+        
+        Example usage:
+            election.render_reports('output', samples['support'],
+                house_effects=samples['pollster_house_effects_b'],
+                correlation_matrices=utils.compute_correlations(samples['cholesky_matrix']))
+        
+        See reports.render_reports for the reports, languages and options.
+        """
+        # The summary, including the representative sample and the seat
+        # intervals of the mandates report, is computed once here, and is
+        # inherited by the workers of all the reports and languages
+        if forecast_summary is None:
+            if burn is None:
+                burn = -min(len(support), 1000)
+            forecast_summary = self.create_forecast_summary(support, bader_ofer, burn)
+        mandates_options = (options or {}).get('mandates', {})
+        if 'max_bo' not in mandates_options:
+            forecast_summary.representative_seats(mandates_options.get('day', 0))
+        if mandates_options.get('interval_method', 'normal') != 'normal':
+            forecast_summary.seats_intervals(0.95, mandates_options['interval_method'])
+
+        arrays = { 'house_effects': house_effects, 'correlation_matrices': correlation_matrices }
+        return reports.render_reports(self, output_dir, arrays, reports=reports,
+            languages=languages, processes=processes, options=options,
+            forecast_summary=forecast_summary)
+
     def plot_correlation_matrix(self, correlation_matrix, hebrew=False):
         """
         Plot the given correlation matrix.
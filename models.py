@@ -5,9 +5,9 @@ A collection of pymc3 models for political election modeling.
 
 import numpy as np
 import pymc3 as pm
+import theano
 import theano.tensor as tt
 import datetime
-import itertools
 
 from . import polls
 from . import configuration
@@ -20,7 +20,7 @@ class ElectionDynamicsModel(pm.Model):
     """
     def __init__(self, name, votes, polls, party_groups, cholesky_matrix,
                  test_results, house_effects_model, min_polls_per_pollster,
-                 adjacent_day_fn):
+                 adjacent_day_fn, pollster_priors=None, float_type=None):
         super(ElectionDynamicsModel, self).__init__(name)
         
         self.votes = votes
@@ -33,6 +33,9 @@ class ElectionDynamicsModel(pm.Model):
         self.max_poll_days = polls.max_poll_days
         self.num_party_groups = max(self.party_groups) + 1
         self.cholesky_matrix = cholesky_matrix
+        self.house_effects_model = house_effects_model
+        self.pollster_priors = pollster_priors
+        self.float_type = theano.config.floatX if float_type is None else float_type
         if type(adjacent_day_fn) in [int, float]:
             self.adjacent_day_fn = lambda diff: (1. + diff) ** adjacent_day_fn
         else:
@@ -51,10 +54,10 @@ class ElectionDynamicsModel(pm.Model):
         # influences polls, evolving support and election day
         # vote.
         self.innovations = pm.MvNormal('innovations',
-            mu=np.zeros([self.num_days, self.num_parties]),
+            mu=np.zeros([self.num_days, self.num_parties], dtype=self.float_type),
             chol=self.cholesky_matrix,
             shape=[self.num_days, self.num_parties],
-            testval=np.zeros([self.num_days, self.num_parties]))
+            testval=np.zeros([self.num_days, self.num_parties], dtype=self.float_type))
             
         # The random walk itself is a cumulative sum of the innovations.
         self.walk = pm.Deterministic('walk', self.innovations.cumsum(axis=0))
@@ -67,24 +70,21 @@ class ElectionDynamicsModel(pm.Model):
         # In some cases, we might want to filter pollsters without a minimum
         # number of polls. Because these pollsters produced only a few polls,
         # we cannot determine whether their results are biased or not.
-        polls_per_pollster = { 
-            pollster_id: sum(1 for p in self.polls if p.pollster_id == pollster_id) 
-            for pollster_id in range(self.num_pollsters) }
+        polls_per_pollster = np.bincount(self.polls.poll_pollster_ids, minlength=self.num_pollsters)
         
         self.min_polls_per_pollster = min_polls_per_pollster
         
-        self.num_pollsters_in_model = 0
-        self.pollster_mapping = {}
-    
-        for pollster_id, count in polls_per_pollster.items():
-            if count >= self.min_polls_per_pollster:
-                self.pollster_mapping[pollster_id] = self.num_pollsters_in_model
-                self.num_pollsters_in_model += 1
-            else:
-                self.pollster_mapping[pollster_id] = None
+        # The index of each pollster among the modeled pollsters, or -1 if
+        # it is filtered out. The pollster_mapping dict holds the same,
+        # with None for filtered pollsters.
+        modeled = polls_per_pollster >= self.min_polls_per_pollster
+        self.num_pollsters_in_model = int(modeled.sum())
+        self.pollster_index = np.where(modeled, np.cumsum(modeled) - 1, -1)
+        self.pollster_mapping = { pollster_id: int(index) if index >= 0 else None
+            for pollster_id, index in enumerate(self.pollster_index) }
         
-        self.filtered_polls = [ p for p in self.polls 
-                               if polls_per_pollster[p.pollster_id] >= self.min_polls_per_pollster ]
+        self.filtered_mask = modeled[self.polls.poll_pollster_ids]
+        self.filtered_polls = [ p for p, modeled_poll in zip(self.polls, self.filtered_mask) if modeled_poll ]
         
         if self.min_polls_per_pollster > 1:
           print ("Some polls were filtered out. Provided polls: %d, filtered: %d, final total: %d" % 
@@ -93,11 +93,14 @@ class ElectionDynamicsModel(pm.Model):
         # Group polls by number of days. This is necessary to allow generating
         # a different cholesky matrix for each. This corresponds to the 
         # average of the modeled support used for multi-day polls.
-        group_polls = lambda poll: poll.num_poll_days
+        # The indices of the polls of each group are kept along with the polls.
+        self.grouped_poll_indices = { num_poll_days:
+                np.where(self.filtered_mask & (self.polls.poll_num_days == num_poll_days))[0]
+            for num_poll_days in np.unique(self.polls.poll_num_days[self.filtered_mask]) }
 
         # Group the polls and create the likelihood variable.
-        self.grouped_polls = [ (num_poll_days, [p for p in polls]) for num_poll_days, polls in
-            itertools.groupby(sorted(self.filtered_polls, key=group_polls), group_polls) ]
+        self.grouped_polls = [ (num_poll_days, [ self.polls.polls[i] for i in indices ])
+            for num_poll_days, indices in self.grouped_poll_indices.items() ]
             
         # To handle multiple-day polls, we average the party support for the
         # relevant days
@@ -112,41 +115,305 @@ class ElectionDynamicsModel(pm.Model):
             if self.adjacent_day_fn is None:
                 return [ expected_poll_outcome(p) for p in polls ] + self.votes
             else:
-                weights = np.asarray([[ 
-                    sum(self.adjacent_day_fn(abs(d - poll_day)) 
-                        for poll_day in range(p.end_day, p.start_day + 1)) 
-                    for d in range(self.num_days) ]
-                    for p in polls])
-                return tt.dot(weights / weights.sum(axis=1, keepdims=True), self.walk + self.votes)
+                return tt.dot(self.compute_poll_weights(polls).astype(self.float_type), self.walk + self.votes)
         
         self.mus = { num_poll_days: expected_polls_outcome(polls)
                 for num_poll_days, polls in self.grouped_polls }
 
         self.create_house_effects(house_effects_model)
 
-        self.likelihoods = [
-            # The Multivariate Student-T variable that models the polls.
-            #
-            # The polls are modeled as a MvStudentT distribution which allows to
-            # take into consideration the number of people polled as well as the
-            # cholesky-covariance matrix that is central to the model.
-
-            # Because we average the support over the number of poll days n, we
-            # also need to appropriately factor the cholesky matrix. We assume
-            # no correlation between different days, so the factor is 1/n for 
-            # the variance, and 1/sqrt(n) for the cholesky matrix.
-            pm.MvStudentT(
-                'polls_%d_days' % num_poll_days,
-                nu=[ p.num_polled - 1 for p in polls ],
-                mu=self.mus[num_poll_days],
-                chol=self.cholesky_matrix / np.sqrt(num_poll_days),
-                testval=test_results,
-                shape=[len(polls), self.num_parties],
-                observed=[ p.percentages for p in polls ])
-            for num_poll_days, polls in self.grouped_polls ]
+        self.likelihoods = [ self.create_likelihood(num_poll_days, indices, test_results)
+            for num_poll_days, indices in self.grouped_poll_indices.items() ]
+
+    def create_likelihood(self, num_poll_days, indices, test_results):
+        """
+        Create the likelihood of the polls of the given number of days,
+        given their indices.
+        """
+        # The Multivariate Student-T variable that models the polls.
+        #
+        # The polls are modeled as a MvStudentT distribution which allows to
+        # take into consideration the number of people polled as well as the
+        # cholesky-covariance matrix that is central to the model.
+
+        # Because we average the support over the number of poll days n, we
+        # also need to appropriately factor the cholesky matrix. We assume
+        # no correlation between different days, so the factor is 1/n for 
+        # the variance, and 1/sqrt(n) for the cholesky matrix.
+        name = 'polls_%d_days' % num_poll_days
+        nu = (self.polls.poll_num_polled[indices] - 1).astype(self.float_type)
+        chol = self.cholesky_matrix / np.asarray(np.sqrt(num_poll_days), dtype=self.float_type)
+        observed = self.polls.poll_percentages[indices]
+        weights = self.polls.poll_weights[indices]
+        if np.all(weights == 1):
+            return pm.MvStudentT(name, nu=nu, mu=self.mus[num_poll_days], chol=chol,
+                testval=test_results, shape=[len(indices), self.num_parties],
+                observed=observed)
+
+        # The weights of the polls' series scale their log-likelihoods
+        distribution = pm.MvStudentT.dist(nu=nu, mu=self.mus[num_poll_days], chol=chol,
+            shape=[len(indices), self.num_parties])
+        return pm.Potential(name, (weights.astype(self.float_type) *
+            distribution.logp(observed.astype(self.float_type))).sum())
+        
+    def compute_poll_weights(self, polls):
+        """
+        Compute the weights of each day in the expected outcome of each
+        poll, as a normalized npolls x ndays matrix. Without an
+        adjacent_day_fn, the poll days are weighted equally.
+        """
+        return self.compute_day_weights(
+            np.asarray([ p.start_day for p in polls ], dtype='int64').reshape(-1),
+            np.asarray([ p.num_poll_days for p in polls ], dtype='int64').reshape(-1))
+
+    def compute_day_weights(self, start_days, num_poll_days):
+        """
+        compute_poll_weights, given the start day and number of days of
+        each poll as arrays.
+        """
+        start_days = np.asarray(start_days, dtype='int64').reshape(-1)
+        num_poll_days = np.asarray(num_poll_days, dtype='int64').reshape(-1)
+        if len(start_days) == 0:
+            return np.zeros([0, self.num_days])
+        max_poll_days = num_poll_days.max()
+
+        # The days of each poll, npolls x max_poll_days, masked beyond its
+        # number of days
+        poll_days = start_days[:, None] - np.arange(max_poll_days)
+        in_poll = np.arange(max_poll_days) < num_poll_days[:, None]
+        days = np.arange(self.num_days)
+
+        if self.adjacent_day_fn is None:
+            weights = ((days[None, :, None] == poll_days[:, None, :]) & in_poll[:, None, :]).sum(axis=2)
+        else:
+            # The function is evaluated once per distance in days
+            distances = np.abs(days[None, :, None] - poll_days[:, None, :])
+            day_weights = np.asarray([ self.adjacent_day_fn(diff) for diff in range(distances.max() + 1) ])
+            weights = (day_weights[distances] * in_poll[:, None, :]).sum(axis=2)
+        weights = weights.astype('float64')
+        return weights / weights.sum(axis=1, keepdims=True)
+
+    def compute_polls_log_likelihood(self, samples, polls, offsets=None,
+                                     chunk_size=100, random_seed=None):
+        """
+        Compute the log-likelihood of each of the given polls under each
+        sample of the posterior, as a nsamples x npolls matrix. This is the
+        numpy counterpart of the polls' MvStudentT likelihood, so polls
+        that are not part of the model can be evaluated as well.
+        
+        samples may be a trace or a dict of the model variables.
+
+        The house effects of pollsters that are not in the model are
+        taken to be neutral, with the mean pollster variance. offsets
+        should be nsamples x npolls x (1 or nparties) for the variance
+        models; if not given they are drawn from their prior. The
+        log-likelihood of each poll is scaled by its weight, as in the
+        model.
+        """
+        from scipy.special import gammaln
+
+        num_parties = self.num_parties
+        support = samples[self.walk.name] + samples[self.votes.name][:, None]
+        cholesky_matrix = samples[self.cholesky_matrix.name]
+        num_samples = len(support)
+        
+        inverse_cholesky = np.linalg.inv(cholesky_matrix)
+        log_det = np.log(np.diagonal(cholesky_matrix, axis1=1, axis2=2)).sum(axis=1)
         
+        house_effects = self.get_house_effects(samples, [ p.pollster_id for p in polls ])
+        if house_effects is not None:
+            a, b, sigmas, pollster_ids = house_effects
+            if offsets is None:
+                offsets = np.random.RandomState(random_seed).standard_normal(
+                    [num_samples, len(polls), sigmas.shape[2]])
+
+        log_likelihood = np.empty([num_samples, len(polls)])
+        for start in range(0, len(polls), chunk_size):
+            chunk = polls[start:start + chunk_size]
+            mu = np.einsum('nd,sdp->snp', self.compute_poll_weights(chunk), support)
+            if house_effects is not None:
+                ids = pollster_ids[start:start + chunk_size]
+                mu = a[:, ids] * mu + b[:, ids] + sigmas[:, ids] * offsets[:, start:start + len(chunk)]
+            
+            num_poll_days = np.asarray([ p.num_poll_days for p in chunk ], dtype='float64')
+            nu = np.asarray([ p.num_polled - 1 for p in chunk ], dtype='float64')
+            weights = np.asarray([ p.weight for p in chunk ], dtype='float64')
+            observed = np.asarray([ np.asarray(p.percentages, dtype='float64') for p in chunk ])
+            
+            # The cholesky matrix of a poll is scaled by 1/sqrt(num_poll_days)
+            z = np.einsum('spq,snq->snp', inverse_cholesky, observed - mu)
+            quad_dist = (z ** 2).sum(axis=2) * num_poll_days
+            log_likelihood[:, start:start + len(chunk)] = weights * (
+                gammaln((nu + num_parties) / 2) - gammaln(nu / 2) -
+                0.5 * num_parties * np.log(nu * np.pi) -
+                (log_det[:, None] - 0.5 * num_parties * np.log(num_poll_days)) -
+                (nu + num_parties) / 2 * np.log1p(quad_dist / nu))
+        
+        return log_likelihood
+
+    def get_house_effects(self, samples, pollster_ids):
+        """
+        Gather the house effects of the given pollsters from the samples,
+        as (a, b, sigmas, index), where the per-pollster a and b are
+        nsamples x (npollsters + 1) x nparties, the sigmas nsamples x
+        (npollsters + 1) x (1 or nparties), and index maps each of the
+        given pollsters to its entry. Pollsters that are not in the model
+        map to the last, neutral, entry, with the mean pollster variance.
+
+        Returns None if the model has no house effects.
+        """
+        model = self.house_effects_model
+        if model in [ None, 'raw-polls' ]:
+            return None
+
+        num_parties = self.num_parties
+        num_samples = len(samples[self.pollster_sigmas.name])
+        pollster_ids = np.asarray(pollster_ids, dtype='int64').reshape(-1)
+        if model in [ 'variance', 'party-variance' ]:
+            num_modeled = self.num_pollsters
+            index = np.where(pollster_ids < num_modeled, pollster_ids, num_modeled)
+            a = np.ones([num_samples, num_modeled + 1, num_parties])
+            b = np.zeros([num_samples, num_modeled + 1, num_parties])
+        else:
+            num_modeled = self.num_pollsters_in_model
+            # Filtered out (-1) and unknown pollsters map to the neutral entry
+            known = (pollster_ids >= 0) & (pollster_ids < len(self.pollster_index))
+            index = np.full(len(pollster_ids), -1, dtype='int64')
+            index[known] = self.pollster_index[pollster_ids[known]]
+            index[index < 0] = num_modeled
+            a = np.concatenate([ samples[self.pollster_house_effects_a.name],
+                                 np.ones([num_samples, 1, num_parties]) ], axis=1)
+            b = np.concatenate([ samples[self.pollster_house_effects_b.name],
+                                 np.zeros([num_samples, 1, num_parties]) ], axis=1)
+        sigmas = samples[self.pollster_sigmas.name]
+        sigmas = np.concatenate([ sigmas, sigmas.mean(axis=1, keepdims=True) ], axis=1)
+        return a, b, sigmas, index
+
+    def simulate_polls(self, samples, pollster_ids, days, num_poll_days=1, num_polled=None,
+                       batch_size=500, random_seed=None):
+        """
+        Simulate the polls the given pollsters would publish on the given
+        days, under each sample of the posterior. This is the posterior
+        predictive of the polls' MvStudentT likelihood, computed in numpy
+        from the walk, votes, house effects and cholesky matrices, without
+        evaluating the model's graph.
+
+        pollster_ids, days (the start day index of each poll),
+        num_poll_days and num_polled are broadcast to one value per
+        simulated poll. num_polled defaults to the mean number polled
+        of each pollster's modeled polls. The simulated polls are
+        unweighted.
+
+        samples may be a trace or a dict of the model variables. Yields,
+        for each batch of batch_size samples, the index of its first sample
+        and its nsamples x npolls x nparties simulated polls.
+
+        Example usage:
+            for start, polls in dynamics.simulate_polls(trace, [0, 1], 0):
+                ...
+        """
+        if num_polled is None:
+            num_polled = self.get_pollsters_num_polled(pollster_ids)
+        pollster_ids, days, num_poll_days, num_polled = np.broadcast_arrays(
+            np.asarray(pollster_ids, dtype='int64'), np.asarray(days, dtype='int64'),
+            np.asarray(num_poll_days, dtype='int64'), np.asarray(num_polled, dtype='float64'))
+        pollster_ids, days, num_poll_days, num_polled = [ np.ravel(x)
+            for x in (pollster_ids, days, num_poll_days, num_polled) ]
+        assert (days - num_poll_days).min() >= -1 and days.max() < self.num_days, \
+            'the simulated polls should be within the modeled days'
+        num_parties = self.num_parties
+        num_simulated = len(days)
+        nu = num_polled - 1
+
+        # Materialize the trace variables once, as the batches slice them
+        varnames = [ self.walk.name, self.votes.name, self.cholesky_matrix.name ]
+        if self.house_effects_model not in [ None, 'raw-polls' ]:
+            varnames += [ self.pollster_sigmas.name ]
+            if self.house_effects_model not in [ 'variance', 'party-variance' ]:
+                varnames += [ self.pollster_house_effects_a.name, self.pollster_house_effects_b.name ]
+        samples = { name: np.asarray(samples[name]) for name in varnames }
+        num_samples = len(samples[self.votes.name])
+
+        weights = self.compute_day_weights(days, num_poll_days)
+        # Only the days that the simulated polls cover are needed
+        weighted_days = np.flatnonzero(weights.any(axis=0))
+        weights = weights[:, weighted_days]
+        rng = np.random.RandomState(random_seed)
+
+        for start in range(0, num_samples, batch_size):
+            batch = { name: values[start:start + batch_size] for name, values in samples.items() }
+            batch_samples = len(batch[self.votes.name])
+            support = batch[self.walk.name][:, weighted_days] + batch[self.votes.name][:, None]
+            mu = np.einsum('nd,sdp->snp', weights, support)
+
+            house_effects = self.get_house_effects(batch, pollster_ids)
+            if house_effects is not None:
+                a, b, sigmas, index = house_effects
+                offsets = rng.standard_normal([batch_samples, num_simulated, sigmas.shape[2]])
+                mu = a[:, index] * mu + b[:, index] + sigmas[:, index] * offsets
+
+            # A multivariate t draw is a normal draw, with the cholesky
+            # matrix scaled by 1/sqrt(num_poll_days), divided by the square
+            # root of a chi-square draw over its degrees of freedom
+            z = rng.standard_normal([batch_samples, num_simulated, num_parties])
+            normal = np.einsum('spq,snq->snp', batch[self.cholesky_matrix.name], z)
+            scale = np.sqrt(nu / rng.chisquare(nu, [batch_samples, num_simulated]) / num_poll_days)
+            yield start, mu + normal * scale[:, :, None]
+
+    def get_pollsters_num_polled(self, pollster_ids):
+        """
+        The mean number polled of the modeled polls of each of
+        the given pollsters, or of all the modeled polls for pollsters
+        without any.
+        """
+        polls = self.get_modeled_polls()
+        poll_pollsters = np.asarray([ p.pollster_id for p in polls ], dtype='int64')
+        num_polled = np.asarray([ p.num_polled for p in polls ], dtype='float64')
+        pollster_ids = np.asarray(pollster_ids, dtype='int64')
+        means = [ num_polled[poll_pollsters == pollster_id].mean()
+            if (poll_pollsters == pollster_id).any() else num_polled.mean()
+            for pollster_id in pollster_ids.ravel() ]
+        return np.asarray(means).reshape(pollster_ids.shape)
+
+    def get_modeled_polls(self):
+        """
+        The polls in the likelihood, in the order of their likelihood
+        variables and offsets.
+        """
+        return [ p for num_poll_days, polls in self.grouped_polls for p in polls ]
+
+    def compute_trace_log_likelihood(self, samples):
+        """
+        Compute the pointwise log-likelihood of the modeled polls (see
+        get_modeled_polls) under each sample, as a nsamples x npolls
+        matrix, using the sampled offsets of the variance models.
+        """
+        offsets = None
+        if len(self.offsets) > 0:
+            offsets = np.concatenate([ np.asarray(samples[self.offsets[num_poll_days].name])
+                for num_poll_days, polls in self.grouped_polls ], axis=1)
+        return self.compute_polls_log_likelihood(samples, self.get_modeled_polls(), offsets)
+
+    def get_pollster_prior_scales(self, pollster_ids, name, default):
+        """
+        The prior scale of a house-effects parameter for the given pollsters
+        (ids in the polls), as a column. It is shared by pollster name
+        across cycles if pollster_priors are given (see
+        MultiCycleElectionModel), and the default otherwise.
+        """
+        if self.pollster_priors is None:
+            return default
+        shared_ids = [ self.pollster_priors['pollsters'].index(self.polls.pollster_ids[pollster_id])
+                       for pollster_id in pollster_ids ]
+        return self.pollster_priors[name][shared_ids]
+
     def create_house_effects(self, house_effects_model, pollster_sigma_beta = 0.05):
         # Create the appropriate house-effects model, if needed.
+        self.offsets = {}
+
+        # The pollsters in the model, in the order of their parameters
+        modeled_pollsters = sorted([ pollster_id for pollster_id, index in self.pollster_mapping.items()
+            if index is not None ], key=self.pollster_mapping.get)
         if house_effects_model == 'raw-polls':
             return self.mus
 
@@ -169,7 +436,8 @@ class ElectionDynamicsModel(pm.Model):
             
             if house_effects_model in [ 'add-mean', 'add-mean-variance', 'lin-mean', 'lin-mean-variance' ]:
                 self.pollster_house_effects_b__ = pm.Normal(
-                    'pollster_house_effects_b__', 0, 0.05,
+                    'pollster_house_effects_b__', 0,
+                    self.get_pollster_prior_scales(modeled_pollsters[:-1], 'house_effects_scales', 0.05),
                     shape=[self.num_pollsters_in_model - 1, self.num_parties - 1],
                     testval=tt.zeros([self.num_pollsters_in_model - 1, self.num_parties - 1]))
                 self.pollster_house_effects_b_ = pm.Deterministic(
@@ -186,7 +454,8 @@ class ElectionDynamicsModel(pm.Model):
             # variable.
             if house_effects_model in [ 'add-mean-variance', 'mult-mean-variance', 'lin-mean-variance' ]:
                 self.pollster_sigmas = pm.HalfCauchy('pollster_sigmas',
-                    pollster_sigma_beta, shape=[self.num_pollsters_in_model, 1])
+                    self.get_pollster_prior_scales(modeled_pollsters, 'sigma_scales', pollster_sigma_beta),
+                    shape=[self.num_pollsters_in_model, 1])
             else:
                 self.pollster_sigmas = pm.Deterministic('pollster_sigmas', 
                     tt.zeros([self.num_pollsters_in_model, 1]))
@@ -206,7 +475,7 @@ class ElectionDynamicsModel(pm.Model):
             # Because only the mean is modified, the same grouping
             # as the base model can still be used.
             def create_lin_mean_variance_mu(num_poll_days, polls):
-                pollster_ids = [ self.pollster_mapping[p.pollster_id] for p in polls ]
+                pollster_ids = self.pollster_index[self.polls.poll_pollster_ids[self.grouped_poll_indices[num_poll_days]]]
 
                 if house_effects_model in [ 'add-mean-variance', 'mult-mean-variance', 'lin-mean-variance' ]:
                     offsets = pm.Normal(
@@ -216,6 +485,7 @@ class ElectionDynamicsModel(pm.Model):
                 else:
                     offsets = pm.Deterministic('offsets_%d' % num_poll_days, 
                         tt.zeros([len(polls), 1]))
+                self.offsets[num_poll_days] = offsets
                 
                 return (self.pollster_house_effects_a[pollster_ids] * self.mus[num_poll_days] + 
                         self.pollster_house_effects_b[pollster_ids] +
@@ -232,14 +502,16 @@ class ElectionDynamicsModel(pm.Model):
             # Model the variance of the pollsters as a HalfCauchy
             # variable.
             self.pollster_sigmas = pm.HalfCauchy('pollster_sigmas',
-                pollster_sigma_beta, shape=[self.num_pollsters, 1])
+                self.get_pollster_prior_scales(range(self.num_pollsters), 'sigma_scales', pollster_sigma_beta),
+                shape=[self.num_pollsters, 1])
     
             def create_variance_mu(num_poll_days, polls):
-                pollster_ids = [ p.pollster_id for p in polls ]
+                pollster_ids = self.polls.poll_pollster_ids[self.grouped_poll_indices[num_poll_days]]
                 offsets = pm.Normal(
                     'offsets_%d' % num_poll_days,
                     0, 1, shape=[len(polls), 1],
                     testval=np.zeros([len(polls), 1]))
+                self.offsets[num_poll_days] = offsets
                 
                 return (self.mus[num_poll_days] + self.pollster_sigmas[pollster_ids] * offsets)
                 
@@ -254,14 +526,16 @@ class ElectionDynamicsModel(pm.Model):
             # Model the variance of the pollsters as a HalfCauchy
             # variable.
             self.pollster_sigmas = pm.HalfCauchy('pollster_sigmas',
-                pollster_sigma_beta, shape=[self.num_pollsters, self.num_parties])
+                self.get_pollster_prior_scales(range(self.num_pollsters), 'sigma_scales', pollster_sigma_beta),
+                shape=[self.num_pollsters, self.num_parties])
     
             def create_party_variance_mu(num_poll_days, polls):
-                pollster_ids = [ p.pollster_id for p in polls ]
+                pollster_ids = self.polls.poll_pollster_ids[self.grouped_poll_indices[num_poll_days]]
                 offsets = pm.Normal(
                     'offsets_%d' % num_poll_days,
                     0, 1, shape=[len(polls), self.num_parties],
                     testval=np.zeros([len(polls), self.num_parties]))
+                self.offsets[num_poll_days] = offsets
                 
                 return (self.mus[num_poll_days] + self.pollster_sigmas[pollster_ids] * offsets)
                 
@@ -287,7 +561,8 @@ class ElectionCycleModel(pm.Model):
     def __init__(self, election_model, name, cycle_config, parties, election_polls,
                  eta, adjacent_day_fn, min_polls_per_pollster,
                  test_results=None, real_results=None,
-                 house_effects_model=None):
+                 house_effects_model=None, sd_beta=0.1, pollster_priors=None,
+                 float_type=None):
         super(ElectionCycleModel, self).__init__(name)
 
         self.config = cycle_config
@@ -306,7 +581,7 @@ class ElectionCycleModel(pm.Model):
         # Create the cholesky matrix of the model
         self.cholesky_pmatrix = pm.LKJCholeskyCov('cholesky_pmatrix',
             n=self.num_parties, eta=self.eta,   
-            sd_dist=pm.HalfCauchy.dist(0.1, shape=[self.num_parties]))
+            sd_dist=pm.HalfCauchy.dist(sd_beta, shape=[self.num_parties]))
         self.cholesky_matrix = pm.Deterministic('cholesky_matrix',
             pm.expand_packed_triangular(self.num_parties, self.cholesky_pmatrix))
         
@@ -332,11 +607,33 @@ class ElectionCycleModel(pm.Model):
             cholesky_matrix=self.cholesky_matrix,
             test_results=test_results, house_effects_model=house_effects_model,
             min_polls_per_pollster=min_polls_per_pollster,
-            adjacent_day_fn=adjacent_day_fn)
+            adjacent_day_fn=adjacent_day_fn,
+            pollster_priors=pollster_priors, float_type=float_type)
             
         self.support = pm.Deterministic('support', self.dynamics.support)
 
-class ElectionForecastModel(pm.Model):
+class FloatTypeModel(pm.Model):
+    """
+    A pymc3 model with a float type of its own. theano's floatX is set to
+    the model's float_type only while the model is the active context,
+    e.g. while it is sampled within `with model:`, rather than for the
+    whole process.
+    """
+    float_type = None
+
+    def __enter__(self):
+        flags = theano.config.change_flags(floatX=self.float_type or theano.config.floatX)
+        flags.__enter__()
+        self.__dict__.setdefault('float_type_flags', []).append(flags)
+        return super(FloatTypeModel, self).__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            return super(FloatTypeModel, self).__exit__(*exc_info)
+        finally:
+            self.float_type_flags.pop().__exit__(*exc_info)
+
+class ElectionForecastModel(FloatTypeModel):
     """
     A pymc3 model that models the election forecast, based on
     one or more election cycles.
@@ -347,13 +644,22 @@ class ElectionForecastModel(pm.Model):
                  house_effects_model='add-mean', 
                  extra_avg_days=0, max_poll_days=None, 
                  polls_since=None, min_poll_days=None,
-                 adjacent_day_fn=-2.,
+                 adjacent_day_fn=-2., float_type=None,
                  *args, **kwargs):
 
         super(ElectionForecastModel, self).__init__(*args, **kwargs)
         
         self.config = configuration.Configuration(config)
 
+        # The float type of the model variables, their samples and the
+        # seat computations. float32 halves the memory and bandwidth of
+        # all of them. theano's floatX is set to it while the model is
+        # built, and while it is the active context (see FloatTypeModel).
+        if float_type is None:
+            float_type = self.config['float_type'] if 'float_type' in self.config.config else 'float64'
+        assert float_type in [ 'float32', 'float64' ], "expected float_type to be float32 or float64"
+        self.float_type = float_type
+
         if forecast_election is None:
             forecast_election = max(self.config['cycles'])
         
@@ -366,57 +672,175 @@ class ElectionForecastModel(pm.Model):
             base_elections = [ cycle for cycle in self.config['cycles']
                 if cycle < forecast_election]
 
-        self.forecast_model = self.init_cycle(forecast_election, 
-            forecast_day=forecast_day, real_results=None,
-            extra_avg_days=extra_avg_days, max_poll_days=max_poll_days,
-            polls_since=polls_since, min_poll_days=min_poll_days,
-            adjacent_day_fn=adjacent_day_fn,
-            eta=eta, house_effects_model=house_effects_model,
-            min_polls_per_pollster=min_polls_per_pollster)
+        with theano.config.change_flags(floatX=float_type):
+            self.forecast_model = self.init_cycle(forecast_election, 
+                forecast_day=forecast_day, real_results=None,
+                extra_avg_days=extra_avg_days, max_poll_days=max_poll_days,
+                polls_since=polls_since, min_poll_days=min_poll_days,
+                adjacent_day_fn=adjacent_day_fn,
+                eta=eta, house_effects_model=house_effects_model,
+                min_polls_per_pollster=min_polls_per_pollster)
                
-        self.support = pm.Deterministic('support', self.forecast_model.support)
+            self.support = pm.Deterministic('support', self.forecast_model.support)
+            # The support on the forecast day alone, for monitoring the
+            # sampling without keeping the full support trace
+            self.election_day_support = pm.Deterministic('election_day_support', self.support[0])
 
     def init_cycle(self, cycle, forecast_day, real_results, 
                    eta, min_polls_per_pollster, house_effects_model,
                    extra_avg_days, max_poll_days, polls_since, min_poll_days,
                    adjacent_day_fn):
-        cycle_config = self.config['cycles'][cycle]
-
-        parties = cycle_config['parties']
-
-        # Remove any parties that are no longer participating due to unions
-        # (Percentages in polls will be accounted for separately)
-        party_unions = { p: parties[p]['union_of'] for p in parties if 'union_of' in parties[p] }
-        for composite, components in party_unions.items():
-            for c in components:
-                if c != composite and c in parties:
-                    del parties[c]
-
-        # Remove any parties that are no longer participating due to dissolutions
-        for p in [ id for id, party in parties.items() if 'dissolved' in party ]:
-            del parties[p]
-        
-        # Read the polls
-        # Note that only the first polls series will actually be used
-        for i, poll_config in enumerate(cycle_config['polls']):
-            self.config.read_polls(cycle_config, {'%s-%d' % (cycle, i): poll_config})
-        
-        # Use the election day if the forecast day was not provided
-        if forecast_day is None:
-            forecast_day = datetime.datetime.strptime(cycle_config['election_day'], '%d/%m/%Y').date()
-
-        # Multiple poll datasets are not yet supported at this
-        # interface so use the first dataset ('-0')
-        election_polls = polls.ElectionPolls(
-            self.config.dataframes['polls']['%s-0' % cycle],
-            parties.keys(), forecast_day, extra_avg_days,
-            max_poll_days, polls_since, min_poll_days)
-        
-        test_results = [ np.nan_to_num(f) for f in election_polls.get_last_days_average(10)]
+        cycle_config, parties, election_polls, test_results = read_cycle(self.config, cycle,
+            forecast_day, extra_avg_days, max_poll_days, polls_since, min_poll_days)
 
         return ElectionCycleModel(self, cycle, cycle_config, parties,
             election_polls=election_polls, eta=eta,
             adjacent_day_fn=adjacent_day_fn,
             test_results=test_results, real_results=real_results,
             house_effects_model=house_effects_model,
-            min_polls_per_pollster=min_polls_per_pollster)
+            min_polls_per_pollster=min_polls_per_pollster,
+            float_type=self.float_type)
+
+def read_cycle(config, cycle, forecast_day, extra_avg_days, max_poll_days,
+               polls_since, min_poll_days):
+    """
+    Read the parties and polls of an election cycle. Returns the cycle's
+    configuration, its parties, its ElectionPolls and the test values of
+    its results.
+    """
+    cycle_config = config['cycles'][cycle]
+
+    parties = cycle_config['parties']
+
+    # Remove any parties that are no longer participating due to unions
+    # (Percentages in polls will be accounted for separately)
+    party_unions = { p: parties[p]['union_of'] for p in parties if 'union_of' in parties[p] }
+    for composite, components in party_unions.items():
+        for c in components:
+            if c != composite and c in parties:
+                del parties[c]
+
+    # Remove any parties that are no longer participating due to dissolutions
+    for p in [ id for id, party in parties.items() if 'dissolved' in party ]:
+        del parties[p]
+    
+    # Read the polls series
+    for i, poll_config in enumerate(cycle_config['polls']):
+        config.read_polls(cycle_config, {'%s-%d' % (cycle, i): poll_config})
+    
+    # Use the election day if the forecast day was not provided
+    if forecast_day is None:
+        forecast_day = datetime.datetime.strptime(cycle_config['election_day'], '%d/%m/%Y').date()
+
+    # Several series are merged, and each series may be given a weight
+    # relative to the others. A single series is used as is.
+    polls_datasets = [ config.dataframes['polls']['%s-%d' % (cycle, i)]
+                       for i in range(len(cycle_config['polls'])) ]
+    if len(polls_datasets) == 1:
+        polls_datasets = polls_datasets[0]
+    election_polls = polls.ElectionPolls(
+        polls_datasets, parties.keys(), forecast_day, extra_avg_days,
+        max_poll_days, polls_since, min_poll_days,
+        weights=[ float(poll_config['weight']) if 'weight' in poll_config else 1.
+                  for poll_config in cycle_config['polls'] ])
+    
+    test_results = [ np.nan_to_num(f) for f in election_polls.get_last_days_average(10)]
+
+    return cycle_config, parties, election_polls, test_results
+
+class MultiCycleElectionModel(FloatTypeModel):
+    """
+    A pymc3 model that fits several election cycles together in a single
+    graph, so that they are compiled and sampled once rather than once
+    per cycle.
+
+    The cycles share the hyperpriors of their party correlations: the
+    LKJ eta and the scale of the parties' standard deviations. Pollsters
+    are matched by name across the cycles, and share the scales of their
+    house effects and of their variances. Only these scales are shared:
+    each cycle has its own house effects and correlations.
+
+    The past cycles are not conditioned on their election results, which
+    the configuration does not hold, so their election-day votes are as
+    free as those of the forecast cycle (see ElectionCycleModel's
+    real_results, which is likewise unused). A pollster's house effects in
+    a past cycle are thus only identified relative to the other pollsters
+    of that cycle, and what carries over to the forecast cycle is how
+    widely its house effects and variances spread, not their direction.
+
+    Each cycle keeps its own parties and days. The forecast cycle, the
+    latest one by default, is available as forecast_model, and its support
+    as support, as in ElectionForecastModel. This is not an
+    israel.IsraeliElectionForecastModel, so its seats are not computed by
+    the model; the support trace may still be passed to the module
+    functions of israel, e.g. compute_bader_ofer.
+    """
+    def __init__(self, config, cycles=None, forecast_election=None,
+                 forecast_days=None, min_polls_per_pollster=1,
+                 house_effects_model='add-mean',
+                 extra_avg_days=0, max_poll_days=None,
+                 polls_since=None, min_poll_days=None,
+                 adjacent_day_fn=-2., pollster_sigma_beta=0.05,
+                 float_type=None, *args, **kwargs):
+
+        super(MultiCycleElectionModel, self).__init__(*args, **kwargs)
+
+        self.config = configuration.Configuration(config)
+
+        if float_type is None:
+            float_type = self.config['float_type'] if 'float_type' in self.config.config else 'float64'
+        assert float_type in [ 'float32', 'float64' ], "expected float_type to be float32 or float64"
+        self.float_type = float_type
+
+        if cycles is None:
+            cycles = sorted(self.config['cycles'])
+        if forecast_election is None:
+            forecast_election = max(cycles)
+        assert forecast_election in cycles, "expected the forecast election to be one of the cycles"
+        if forecast_days is None:
+            forecast_days = {}
+        self.cycles = cycles
+        self.forecast_election = forecast_election
+
+        # Only the forecast cycle is limited to the polls up to the forecast
+        # day; past cycles use their polls up to their election day.
+        cycles_data = { cycle: read_cycle(self.config, cycle,
+                forecast_days.get(cycle), extra_avg_days,
+                max_poll_days if cycle == forecast_election else None,
+                polls_since if cycle == forecast_election else None,
+                min_poll_days)
+            for cycle in cycles }
+
+        # theano's floatX is the model's float type while it is built, and
+        # while it is the active context (see FloatTypeModel)
+        with theano.config.change_flags(floatX=float_type):
+            # The shared hyperpriors of the party correlations
+            self.eta = pm.Gamma('eta', 2, 1)
+            self.sd_beta = pm.HalfNormal('sd_beta', 0.1)
+
+            # The shared pollster scales, by pollster name
+            pollsters = sorted(set(pollster for cycle_config, parties, election_polls, test_results
+                in cycles_data.values() for pollster in election_polls.pollster_ids), key=str)
+            self.pollsters = pollsters
+            self.pollster_priors = {
+                'pollsters': pollsters,
+                'house_effects_scales': pm.HalfNormal('pollster_house_effects_scales',
+                    0.05, shape=[len(pollsters), 1]),
+                'sigma_scales': pm.HalfCauchy('pollster_sigma_scales',
+                    pollster_sigma_beta, shape=[len(pollsters), 1]) }
+
+            self.cycle_models = {}
+            for cycle in cycles:
+                cycle_config, parties, election_polls, test_results = cycles_data[cycle]
+                self.cycle_models[cycle] = ElectionCycleModel(self, cycle, cycle_config, parties,
+                    election_polls=election_polls, eta=self.eta,
+                    adjacent_day_fn=adjacent_day_fn,
+                    test_results=test_results,
+                    house_effects_model=house_effects_model,
+                    min_polls_per_pollster=min_polls_per_pollster,
+                    sd_beta=self.sd_beta, pollster_priors=self.pollster_priors,
+                    float_type=float_type)
+
+            self.forecast_model = self.cycle_models[forecast_election]
+            self.support = pm.Deterministic('support', self.forecast_model.support)
+            self.election_day_support = pm.Deterministic('election_day_support', self.support[0])
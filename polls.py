@@ -3,70 +3,166 @@ import pandas as pd
 import datetime as dt
 
 class Poll:
-    def __init__(self, poll_id, num_polled, start_day, num_poll_days, percentages, pollster_id):
+    def __init__(self, poll_id, num_polled, start_day, num_poll_days, percentages, pollster_id,
+                 weight=1.):
         assert num_polled >= 100, "expected num_polled >= 100, but was %d" % num_polled
         self.poll_id = poll_id
         self.num_polled = num_polled
+        # The weight of the poll's source scales the poll's log-likelihood
+        self.weight = weight
         self.start_day = start_day
         self.end_day = start_day - num_poll_days + 1
         self.num_poll_days = num_poll_days
         self.percentages = percentages
         self.pollster_id = pollster_id
        
+def merge_polls_datasets(polls_datasets, weights=None):
+    """
+    Merge several series of polls into a single dataset, with the weight
+    of each poll's series in a 'weight' column. Polls that appear in more
+    than one series, i.e. with the same pollster, start date and number of
+    days, are kept only from the series with the highest weight (the first
+    one on ties). Such polls within a single series, e.g. a pollster's
+    polls for two outlets on the same day, are all kept. All the series
+    should have the same columns.
+    """
+    if weights is None:
+        weights = [ 1. ] * len(polls_datasets)
+    assert len(weights) == len(polls_datasets), "expected a weight for each polls series"
+    if len(polls_datasets) == 1:
+        return polls_datasets[0].assign(weight=weights[0])
+
+    polls_datasets = [ dataset.rename(columns={'poller': 'pollster'}) for dataset in polls_datasets ]
+    columns = set.union(*[ set(dataset.columns) for dataset in polls_datasets ])
+    for source, dataset in enumerate(polls_datasets):
+        missing_columns = sorted(columns - set(dataset.columns), key=str)
+        assert len(missing_columns) == 0, "columns %s are missing in polls series %d" % (str(missing_columns), source)
+
+    merged = pd.concat([ dataset.assign(source=source, weight=weight)
+        for source, (dataset, weight) in enumerate(zip(polls_datasets, weights)) ],
+        ignore_index=True)
+    merged = merged.sort_values(['weight', 'source'], ascending=[False, True], kind='mergesort')
+    # Keep each poll from the first of the series it appears in
+    first_source = merged.groupby(['pollster', 'start_date', 'num_days'], sort=False)['source'].transform('first')
+    merged = merged[merged['source'] == first_source]
+    return merged.sort_index()
+
 class ElectionPolls:
-    
+    """
+    The polls of an election cycle within the modeled days. polls_dataset
+    may be a single DataFrame, or a list of DataFrames of several series
+    which are merged by merge_polls_datasets with the given weights.
+    """
     def __init__(self, polls_dataset, party_ids, forecast_day,
-                 extra_avg_days=0, max_poll_days=None, polls_since=None, min_poll_days=None):
+                 extra_avg_days=0, max_poll_days=None, polls_since=None, min_poll_days=None,
+                 weights=None):
+        if not isinstance(polls_dataset, pd.DataFrame):
+            polls_dataset = merge_polls_datasets(polls_dataset, weights)
 
-        def day_index(d):
-            if type(d) is pd.Timestamp:
-                d = d.to_pydatetime()
-            if type(d) is dt.datetime:
-                d = d.date()
-            assert type(d) == dt.date, "invalid value given for date: %s" % str(d)
-            return (forecast_day - d).days + (extra_avg_days + 1) // 2
-    
         self.forecast_day = forecast_day
+        self.extra_avg_days = extra_avg_days
         self.party_ids = [p for p in party_ids]
         self.num_parties = len(self.party_ids)
-        self.num_days = day_index(min(polls_dataset['start_date'])) + 1
+        self.num_days = self.day_index(min(polls_dataset['start_date'])) + 1
         if max_poll_days is not None:
             assert polls_since==None, "only one of polls_since or max_poll_days should be provided"
             self.num_days = min(self.num_days, max_poll_days)
         elif polls_since is not None:
-            polls_since_days = max(day_index(polls_since) + 1, min_poll_days)
+            polls_since_days = max(self.day_index(polls_since) + 1, min_poll_days)
             self.num_days = min(self.num_days, polls_since_days)
         self.max_poll_days = 0
 
         self.pollster_ids = []
         self.polls = []
+        self.poll_pollster_ids = np.zeros(0, dtype='int64')
+        self.poll_start_days = np.zeros(0, dtype='int64')
+        self.poll_num_days = np.zeros(0, dtype='int64')
+        self.poll_num_polled = np.zeros(0, dtype='int64')
+        self.poll_weights = np.zeros(0)
+        self.poll_percentages = np.zeros([0, self.num_parties])
+        self.add_polls(polls_dataset)
+
+    def day_index(self, d):
+        """
+        Computes the days before the forecast day of a given date.
+        """
+        if type(d) is pd.Timestamp:
+            d = d.to_pydatetime()
+        if type(d) is dt.datetime:
+            d = d.date()
+        assert type(d) == dt.date, "invalid value given for date: %s" % str(d)
+        return (self.forecast_day - d).days + (self.extra_avg_days + 1) // 2
 
+    def add_polls(self, polls_dataset):
+        """
+        Add the polls of a dataset that fall within the modeled days,
+        and return the new Poll objects. Pollsters not seen before are
+        given new pollster ids.
+
+        The polls are also kept in columns: the pollster ids, start days,
+        number of days, number polled, weights and percentages of all the
+        polls, in the order of the Poll objects.
+        """
         missing_parties = [p for p in self.party_ids if p not in polls_dataset.columns]
-        assert len(missing_parties) == 0, "parties %s are missing for %s" % (str(missing_parties), str(forecast_day))
-        for index, poll in polls_dataset.iterrows():
-            percentages = poll[self.party_ids]
-            pollster = poll['pollster'] if 'pollster' in poll else poll['poller']
-            poll_id = poll['id']
-            num_polled = poll['num_polled']
-            num_poll_days = poll['num_days'] + extra_avg_days
-            start_day = day_index(poll['start_date'])
+        assert len(missing_parties) == 0, "parties %s are missing for %s" % (str(missing_parties), str(self.forecast_day))
+
+        start_dates = pd.to_datetime(pd.Series(polls_dataset['start_date']))
+        start_days = ((pd.Timestamp(self.forecast_day) - start_dates).dt.days.to_numpy() +
+                      (self.extra_avg_days + 1) // 2)
+        num_poll_days = polls_dataset['num_days'].to_numpy(dtype='int64') + self.extra_avg_days
+        in_days = (start_days - num_poll_days + 1 >= 0) & (start_days < self.num_days)
+
+        polls_dataset = polls_dataset[in_days]
+        start_days = start_days[in_days]
+        num_poll_days = num_poll_days[in_days]
+        pollsters = (polls_dataset['pollster'] if 'pollster' in polls_dataset.columns
+                     else polls_dataset['poller']).to_numpy()
+        num_polled = polls_dataset['num_polled'].to_numpy()
+        weights = (polls_dataset['weight'].to_numpy(dtype='float64') if 'weight' in polls_dataset.columns
+                   else np.ones(len(polls_dataset)))
+        percentages = polls_dataset[self.party_ids].to_numpy(dtype='float64')
 
-            if start_day - num_poll_days + 1 >= 0 and start_day < self.num_days:
-                assert len(percentages) == self.num_parties, "percentages list does not match"
-                if pollster not in self.pollster_ids:
-                    self.pollster_ids += [ pollster ]
-                poll_id = len(self.polls)
-                self.polls += [ Poll(poll_id, num_polled, start_day, num_poll_days,
-                                     percentages, self.pollster_ids.index(pollster))]
-                self.max_poll_days = max(self.max_poll_days, num_poll_days)
+        self.pollster_ids += [ pollster for pollster in pd.unique(pollsters)
+                               if pollster not in self.pollster_ids ]
+        pollster_ids = pd.Categorical(pollsters, categories=self.pollster_ids).codes.astype('int64')
 
+        first_poll_id = len(self.polls)
+        new_polls = [ Poll(first_poll_id + i, num_polled[i], start_days[i], num_poll_days[i],
+                           percentages[i], pollster_ids[i], weights[i])
+                      for i in range(len(polls_dataset)) ]
+        self.polls += new_polls
+
+        self.poll_pollster_ids = np.concatenate([ self.poll_pollster_ids, pollster_ids ])
+        self.poll_start_days = np.concatenate([ self.poll_start_days, start_days ])
+        self.poll_num_days = np.concatenate([ self.poll_num_days, num_poll_days ])
+        self.poll_num_polled = np.concatenate([ self.poll_num_polled, num_polled ])
+        self.poll_weights = np.concatenate([ self.poll_weights, weights ])
+        self.poll_percentages = np.concatenate([ self.poll_percentages, percentages ])
+        
+        if len(new_polls) > 0:
+            self.max_poll_days = max(self.max_poll_days, int(num_poll_days.max()))
         self.num_pollsters = len(self.pollster_ids)
+        return new_polls
     
+    def truncate(self, num_polls, num_pollsters):
+        """
+        Keep only the first num_polls polls and num_pollsters pollsters,
+        e.g. to undo add_polls.
+        """
+        del self.polls[num_polls:]
+        del self.pollster_ids[num_pollsters:]
+        self.poll_pollster_ids = self.poll_pollster_ids[:num_polls]
+        self.poll_start_days = self.poll_start_days[:num_polls]
+        self.poll_num_days = self.poll_num_days[:num_polls]
+        self.poll_num_polled = self.poll_num_polled[:num_polls]
+        self.poll_weights = self.poll_weights[:num_polls]
+        self.poll_percentages = self.poll_percentages[:num_polls]
+        self.max_poll_days = int(self.poll_num_days.max()) if num_polls > 0 else 0
+        self.num_pollsters = len(self.pollster_ids)
+
     def get_last_days_average(self, num_days):
-        return np.stack([ 
-                p.percentages
-                for p in self.polls 
-                if p.end_day < num_days ], axis=0).mean(axis=0)
+        end_days = self.poll_start_days - self.poll_num_days + 1
+        return self.poll_percentages[end_days < num_days].mean(axis=0)
     
     def __iter__(self):
         return self.polls.__iter__()
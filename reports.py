@@ -0,0 +1,205 @@
+# coding: utf-8
+"""
+Rendering of the full set of forecast report images in a process pool.
+
+The workers are forked from the process holding the model, so the model
+itself is inherited rather than pickled, and the traces are passed to
+them through shared memory. Where fork is not available, e.g. on
+Windows, the reports are rendered in the calling process instead, also
+with the Agg backend.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import sys
+
+import numpy as np
+
+REPORTS = [ 'mandates', 'coalitions', 'support_evolution', 'house_effects',
+            'correlation_matrix', 'correlation_matrices' ]
+
+LANGUAGES = { 'english': False, 'hebrew': True }
+
+# The model being rendered and its forecast summary, set in the parent
+# process before the workers are forked.
+_model = None
+_forecast_summary = None
+
+def share_array(array):
+    """
+    Copy an array into a new shared memory block. Returns the block, which
+    the caller should unlink when done, and a descriptor for attach_array.
+    """
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def attach_array(descriptor):
+    """
+    Attach to an array shared by share_array. Returns the block, which
+    the caller should close when done, and the array.
+    """
+    name, shape, dtype = descriptor
+    if sys.version_info >= (3, 13):
+        block = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        from multiprocessing import resource_tracker
+        block = shared_memory.SharedMemory(name=name)
+        # Only the creating process should unlink the block
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block, np.ndarray(shape, dtype, buffer=block.buf)
+
+def plot_report(model, report, hebrew, arrays, options, forecast_summary=None):
+    """
+    Draw a single report of the model using the given arrays, or, for the
+    seats and support reports, forecast_summary if given.
+    """
+    if report == 'mandates':
+        model.plot_mandates(arrays.get('seats'), hebrew=hebrew,
+            forecast_summary=forecast_summary, **options)
+    elif report == 'coalitions':
+        model.plot_coalitions(arrays.get('seats'), hebrew=hebrew,
+            forecast_summary=forecast_summary, **options)
+    elif report == 'support_evolution':
+        model.plot_party_support_evolution_graphs(arrays.get('support'), arrays.get('seats'),
+            burn=0, hebrew=hebrew, forecast_summary=forecast_summary, **options)
+    elif report == 'house_effects':
+        model.plot_pollster_house_effects(arrays['house_effects'], hebrew=hebrew, **options)
+    elif report == 'correlation_matrix':
+        model.plot_correlation_matrix(arrays['correlation_matrices'].mean(axis=0), hebrew=hebrew, **options)
+    elif report == 'correlation_matrices':
+        model.plot_election_correlation_matrices(arrays['correlation_matrices'], hebrew=hebrew, **options)
+    else:
+        raise ValueError("expected report '%s' to be one of %s" % (report, ', '.join(REPORTS)))
+
+def save_report(model, report, language, arrays, options, output_prefix,
+                forecast_summary=None):
+    """
+    Draw a single report of the model and save its figures as PNG images
+    named by output_prefix. Returns the names of the written files.
+    """
+    import matplotlib.pyplot as plt
+
+    existing_figures = set(plt.get_fignums())
+    plot_report(model, report, LANGUAGES[language], arrays, options, forecast_summary)
+
+    # Some reports, such as the house effects, draw several figures
+    figure_numbers = [ number for number in plt.get_fignums() if number not in existing_figures ]
+    filenames = []
+    for index, figure_number in enumerate(figure_numbers):
+        if len(figure_numbers) == 1:
+            filename = '%s.png' % output_prefix
+        else:
+            filename = '%s-%d.png' % (output_prefix, index + 1)
+        plt.figure(figure_number).savefig(filename, bbox_inches='tight')
+        plt.close(figure_number)
+        filenames += [ filename ]
+    return filenames
+
+def _render_report(args):
+    report, language, descriptors, options, output_prefix = args
+
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+    blocks = []
+    arrays = {}
+    try:
+        for name, descriptor in descriptors.items():
+            block, arrays[name] = attach_array(descriptor)
+            blocks += [ block ]
+
+        plt.close('all')
+        filenames = save_report(_model, report, language, arrays, options, output_prefix,
+            _forecast_summary)
+
+        # Drop the views before closing the shared memory blocks
+        arrays.clear()
+        return filenames
+    finally:
+        arrays.clear()
+        for block in blocks:
+            block.close()
+
+def render_reports(model, output_dir, arrays, reports=None, languages=None,
+                   processes=None, options=None, forecast_summary=None):
+    """
+    Render the reports of the model in all the given languages in a
+    process pool, writing the PNG images to output_dir. Returns the names
+    of the written files.
+
+    arrays holds the traces the reports need: 'support' and 'seats'
+    (samples x days x parties), 'house_effects' and 'correlation_matrices'.
+    If forecast_summary is given, the seats and support reports are drawn
+    from it instead of 'support' and 'seats', and the workers inherit it,
+    so it is computed once for all the reports and languages. Reports
+    whose arrays are missing are skipped. options optionally maps a report
+    to additional arguments of its plot function.
+    """
+    global _model, _forecast_summary
+
+    if reports is None:
+        reports = REPORTS
+    if languages is None:
+        languages = list(LANGUAGES.keys())
+    if options is None:
+        options = {}
+
+    required_arrays = {
+        'mandates': [ 'seats' ],
+        'coalitions': [ 'seats' ],
+        'support_evolution': [ 'support', 'seats' ],
+        'house_effects': [ 'house_effects' ],
+        'correlation_matrix': [ 'correlation_matrices' ],
+        'correlation_matrices': [ 'correlation_matrices' ] }
+    if forecast_summary is not None:
+        for report in [ 'mandates', 'coalitions', 'support_evolution' ]:
+            required_arrays[report] = []
+    reports = [ report for report in reports
+        if all(arrays.get(name) is not None for name in required_arrays[report]) ]
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        # The workers could not inherit the model, so render serially, with
+        # the Agg backend as in the workers. Switching the backend closes
+        # any open figures.
+        import matplotlib.pyplot as plt
+
+        backend = plt.get_backend()
+        plt.switch_backend('Agg')
+        try:
+            return [ filename for report in reports for language in languages
+                for filename in save_report(model, report, language,
+                    { name: arrays[name] for name in required_arrays[report] },
+                    options.get(report, {}), os.path.join(output_dir, '%s-%s' % (report, language)),
+                    forecast_summary) ]
+        finally:
+            plt.switch_backend(backend)
+
+    blocks = []
+    descriptors = {}
+    try:
+        # Only the arrays of the rendered reports are shared
+        for name in set(name for report in reports for name in required_arrays[report]):
+            block, descriptors[name] = share_array(arrays[name])
+            blocks += [ block ]
+
+        tasks = [ (report, language,
+                   { name: descriptors[name] for name in required_arrays[report] },
+                   options.get(report, {}),
+                   os.path.join(output_dir, '%s-%s' % (report, language)))
+                 for report in reports for language in languages ]
+
+        _model, _forecast_summary = model, forecast_summary
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            filenames = pool.map(_render_report, tasks, chunksize=1)
+    finally:
+        _model = _forecast_summary = None
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return [ filename for report_filenames in filenames for filename in report_filenames ]
@@ -0,0 +1,610 @@
+# coding: utf-8
+"""
+Sampling drivers for the election forecast models.
+"""
+
+import copy
+import os
+import pickle
+import queue
+import threading
+import time
+
+import numpy as np
+import pymc3 as pm
+
+from . import israel
+from . import summary
+
+class AdaptiveSampler:
+    """
+    Samples an ElectionForecastModel in rounds, and stops as soon as the
+    convergence diagnostics of the forecast quantities meet the targets
+    rather than after a fixed number of draws.
+
+    The monitored quantities are the election-day support of each party
+    (the model's election_day_support) and the indicators of each party
+    passing the threshold. Between rounds,
+    their rank-normalized R-hat and bulk and tail effective sample sizes
+    are computed across the chains.
+
+    If checkpoint_path is given, the state of the chains is saved there
+    after a round whenever checkpoint_interval seconds have passed since
+    the last checkpoint, and a later run with the same checkpoint_path
+    resumes from it. The checkpoint is removed once sampling completes.
+
+    The chains are stepped one after another in this process, whereas
+    pm.sample runs them in parallel on cores processes (by default as
+    pm.sample does). The report therefore estimates the time of the fixed
+    budget both serially and in parallel, and the time saved is against
+    the parallel estimate. It is negative when stopping early does not
+    make up for the lost parallelism, e.g. with many chains on many cores.
+
+    Example usage:
+        sampler = AdaptiveSampler(model, max_draws=5000)
+        samples = sampler.sample()
+        print(sampler.report)
+    """
+    # The step method attributes that hold the tuned state of NUTS
+    STEP_STATE = [ 'step_size', 'step_adapt', 'potential', 'tune', 'iter_count',
+                   '_samples_after_tune', '_num_divs_sample' ]
+
+    def __init__(self, model, chains=4, tune=1000, draws_per_round=250,
+                 min_draws=500, max_draws=5000, target_rhat=1.01,
+                 target_ess_bulk=400, target_ess_tail=400,
+                 threshold=None, init='jitter+adapt_diag', random_seed=None,
+                 varnames=None, checkpoint_path=None, checkpoint_interval=300,
+                 cores=None):
+        self.model = model
+        self.chains = chains
+        self.tune = tune
+        self.draws_per_round = draws_per_round
+        self.min_draws = min_draws
+        self.max_draws = max_draws
+        self.target_rhat = target_rhat
+        self.target_ess_bulk = target_ess_bulk
+        self.target_ess_tail = target_ess_tail
+        self.init = init
+        self.random_seed = random_seed
+        self.varnames = varnames
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        if cores is None:
+            cores = min(4, os.cpu_count() or 1)
+        self.cores = cores
+
+        if threshold is None:
+            threshold = float(model.forecast_model.config['threshold_percent']) / 100
+        self.threshold = threshold
+
+        self.election_day_name = model.election_day_support.name
+        self.straces = None
+        self.report = None
+
+    def start_chains(self):
+        """
+        Initialize NUTS and set up the trace and starting point of each
+        chain. Each chain holds its own copy of the step method, so its
+        tuned step size and mass matrix carry over from round to round.
+        """
+        start, step = pm.init_nuts(init=self.init, chains=self.chains,
+                                   model=self.model, random_seed=self.random_seed)
+        if self.random_seed is not None:
+            np.random.seed(self.random_seed)
+        trace_vars = self.get_trace_vars()
+        self.steps = []
+        self.straces = []
+        self.points = []
+        for chain in range(self.chains):
+            self.steps += [ copy.deepcopy(step) ]
+            self.steps[chain].tune = bool(self.tune)
+            self.straces += [ pm.backends.NDArray(model=self.model, vars=trace_vars) ]
+            self.setup_trace(chain, self.tune + self.max_draws)
+            self.points += [ pm.Point(dict(self.model.test_point, **start[chain]), model=self.model) ]
+        self.num_draws = 0
+        self.rounds = 0
+
+    def get_trace_vars(self):
+        """
+        The variables to keep in the trace, or None for all of them. If
+        varnames is given, only those variables and the election-day
+        support, which the diagnostics need, are kept.
+        """
+        if self.varnames is None:
+            return None
+        names = set(self.varnames) | { self.election_day_name }
+        return [ self.model.named_vars[name] for name in names ]
+
+    def setup_trace(self, chain, num_draws):
+        """
+        Allocate num_draws more draws in the trace of a chain, after the
+        draws it already holds.
+        """
+        step = self.steps[chain]
+        if step.generates_stats:
+            self.straces[chain].setup(num_draws, chain, step.stats_dtypes)
+        else:
+            self.straces[chain].setup(num_draws, chain)
+
+    def step_chain(self, chain):
+        """
+        Take a single step of a chain from its last point and record it.
+        Tuning stops after the first tune draws.
+
+        The chains are stepped directly rather than by pm.iter_sample,
+        which resets the tuning of the step method when it starts, so that
+        a chain resumed from a checkpoint keeps its tuned state.
+        """
+        step = self.steps[chain]
+        strace = self.straces[chain]
+        if len(strace) == self.tune and step.tune:
+            pm.sampling.stop_tuning(step)
+        if step.generates_stats:
+            point, stats = step.step(self.points[chain])
+            strace.record(point, stats)
+        else:
+            point = step.step(self.points[chain])
+            strace.record(point)
+        self.points[chain] = point
+
+    def save_checkpoint(self):
+        """
+        Save the checkpoint to checkpoint_path.
+        """
+        checkpoint = self.create_checkpoint()
+
+        # Write to a temporary file first, so a run killed while saving
+        # keeps the previous checkpoint
+        with open(self.checkpoint_path + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def create_checkpoint(self):
+        """
+        The draws so far, the tuned state and last point of each chain's
+        step method and the random state, as a dict.
+        """
+        chains = []
+        for chain, strace in enumerate(self.straces):
+            num_draws = len(strace)
+            chains += [ {
+                'samples': { name: values[:num_draws] for name, values in strace.samples.items() },
+                'stats': None if strace._stats is None else
+                    [ { name: values[:num_draws] for name, values in stats.items() }
+                      for stats in strace._stats ],
+                'step': { name: getattr(self.steps[chain], name) for name in self.STEP_STATE
+                          if hasattr(self.steps[chain], name) },
+                'point': self.points[chain] } ]
+        return {
+            'tune': self.tune,
+            'max_draws': self.max_draws,
+            'num_draws': self.num_draws,
+            'rounds': self.rounds,
+            'chains': chains,
+            'random_state': np.random.get_state() }
+
+    def resume_chains(self, checkpoint):
+        """
+        Restore the chains from a checkpoint saved by save_checkpoint, with
+        the saved draws, step method state, last points and random state.
+        New draws are appended to the saved ones.
+        """
+        assert checkpoint['tune'] == self.tune and len(checkpoint['chains']) == self.chains, \
+            "the checkpoint does not match the sampler's tune and chains"
+        trace_vars = self.get_trace_vars()
+        self.num_draws = checkpoint['num_draws']
+        self.rounds = checkpoint['rounds']
+        remaining_draws = self.max_draws - self.num_draws
+
+        self.steps = []
+        self.straces = []
+        self.points = []
+        for chain, state in enumerate(checkpoint['chains']):
+            # Tuning is over by the first checkpoint, so the chains continue
+            # with the tuned step size and mass matrix as saved
+            step = pm.NUTS(model=self.model)
+            for name, value in state['step'].items():
+                setattr(step, name, value)
+            self.steps += [ step ]
+
+            strace = pm.backends.NDArray(model=self.model, vars=trace_vars)
+            strace.chain = chain
+            strace.samples = state['samples']
+            strace._stats = state['stats']
+            strace.draws = strace.draw_idx = self.tune + self.num_draws
+            self.straces += [ strace ]
+            self.setup_trace(chain, remaining_draws)
+            self.points += [ state['point'] ]
+
+        np.random.set_state(checkpoint['random_state'])
+
+    def advance(self, num_draws):
+        """
+        Advance each chain by num_draws draws (after tuning, on the first
+        round). Returns the new draws of the election-day support, as
+        chains x draws x parties.
+        """
+        num_steps = num_draws + (self.tune if self.num_draws == 0 else 0)
+        new_election_day = []
+        for chain, strace in enumerate(self.straces):
+            for _ in range(num_steps):
+                self.step_chain(chain)
+            new_election_day += [ strace.get_values(self.election_day_name)[:len(strace)][-num_draws:] ]
+        self.num_draws += num_draws
+        return np.stack(new_election_day)
+
+    def get_election_day_support(self):
+        """
+        The election-day support of all draws so far, as chains x draws x
+        parties.
+        """
+        return np.stack([ strace.get_values(self.election_day_name)[:len(strace)][self.tune:]
+            for strace in self.straces ])
+
+    def compute_diagnostics(self, election_day):
+        """
+        Compute the worst R-hat and the worst bulk and tail effective sample
+        sizes over the monitored quantities of chains x draws x parties
+        election-day support.
+        """
+        import arviz as az
+
+        passed = (election_day / election_day.sum(axis=2, keepdims=True) >= self.threshold)
+        quantities = np.concatenate([election_day, passed.astype('float64')], axis=2)
+
+        rhat, ess_bulk, ess_tail = [], [], []
+        for index in range(quantities.shape[2]):
+            quantity = quantities[:, :, index]
+            # Constant quantities, e.g. a party that always passes the
+            # threshold, have nothing to converge
+            if np.ptp(quantity) == 0:
+                continue
+            rhat += [ az.rhat(quantity) ]
+            ess_bulk += [ az.ess(quantity, method='bulk') ]
+            ess_tail += [ az.ess(quantity, method='tail') ]
+
+        return {
+            'rhat': np.nanmax(rhat) if len(rhat) > 0 else 1.,
+            'ess_bulk': np.nanmin(ess_bulk) if len(ess_bulk) > 0 else np.inf,
+            'ess_tail': np.nanmin(ess_tail) if len(ess_tail) > 0 else np.inf }
+
+    def is_converged(self, diagnostics):
+        return (diagnostics['rhat'] <= self.target_rhat and
+                diagnostics['ess_bulk'] >= self.target_ess_bulk and
+                diagnostics['ess_tail'] >= self.target_ess_tail)
+
+    def on_round(self, new_election_day):
+        """
+        Called with the new election-day support draws of each round, as
+        chains x draws x parties. Does nothing by default.
+        """
+        pass
+
+    def sample(self):
+        """
+        Sample in rounds until the targets are met or max_draws is reached.
+        Returns the trace without the tuning draws, and sets self.report.
+        """
+        # The model is the active context while sampling, which also sets
+        # its float type (see models.FloatTypeModel)
+        with self.model:
+            return self.sample_rounds()
+
+    def sample_rounds(self):
+        started = time.time()
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'rb') as f:
+                self.resume_chains(pickle.load(f))
+        else:
+            self.start_chains()
+        tuned = None
+        tuned_draws = 0
+        diagnostics = None
+        checkpointed = time.time()
+
+        while self.num_draws < self.max_draws:
+            num_draws = min(self.draws_per_round, self.max_draws - self.num_draws)
+            self.on_round(self.advance(num_draws))
+            self.rounds += 1
+            if tuned is None:
+                tuned = time.time()
+                tuned_draws = self.num_draws
+
+            if (self.checkpoint_path is not None and
+                time.time() - checkpointed >= self.checkpoint_interval):
+                self.save_checkpoint()
+                checkpointed = time.time()
+
+            if self.num_draws >= self.min_draws:
+                diagnostics = self.compute_diagnostics(self.get_election_day_support())
+                if self.is_converged(diagnostics):
+                    break
+
+        finished = time.time()
+
+        # Estimate the time of the fixed budget from the draw rate after
+        # the first (tuning) round
+        if self.num_draws > tuned_draws:
+            time_per_draw = (finished - tuned) / (self.num_draws - tuned_draws)
+        elif tuned_draws > 0:
+            time_per_draw = (tuned - started) / (self.tune + tuned_draws)
+        else:
+            time_per_draw = 0
+        serial_time = finished - started + (self.max_draws - self.num_draws) * time_per_draw
+        # pm.sample runs the chains in batches of cores parallel chains
+        parallel_time = serial_time * int(np.ceil(self.chains / self.cores)) / self.chains
+
+        self.report = {
+            'draws': self.num_draws,
+            'max_draws': self.max_draws,
+            'rounds': self.rounds,
+            'converged': diagnostics is not None and self.is_converged(diagnostics),
+            'diagnostics': diagnostics,
+            'elapsed': finished - started,
+            'cores': self.cores,
+            'estimated_serial_fixed_budget_time': serial_time,
+            'estimated_parallel_fixed_budget_time': parallel_time,
+            'estimated_time_saved': parallel_time - (finished - started) }
+
+        trace = self.get_trace()
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return trace
+
+    def get_trace(self):
+        """
+        Close the chains and combine them into a MultiTrace without the
+        tuning draws.
+        """
+        for strace in self.straces:
+            strace.close()
+        return pm.backends.base.MultiTrace(self.straces)[self.tune:]
+
+class SeatsPipeline:
+    """
+    Computes the Bader-Ofer seats and the forecast summary of batches of
+    support draws while sampling goes on. The seats are computed by a
+    process pool, and a collector thread adds each batch and its seats to
+    a StreamingForecastSummary in the order they were submitted, so the
+    support batches are dropped as soon as they are summarized.
+
+    At most two batches per process are in flight; submit blocks while
+    the pipeline is full.
+
+    Example usage:
+        pipeline = SeatsPipeline(election)
+        pipeline.start()
+        for batch in batches:
+            pipeline.submit(batch)
+        forecast_summary = pipeline.finish()
+    """
+    def __init__(self, election, surpluses=None, threshold=None,
+                 num_seats=israel.KNESSET_SEATS, processes=1, quantiles=(0.025, 0.5, 0.975)):
+        self.election = election
+        self.surpluses = surpluses
+        self.threshold = threshold
+        self.num_seats = num_seats
+        self.processes = processes
+        self.quantiles = quantiles
+        self.pool = None
+
+    def start(self):
+        """
+        Start the process pool and the collector thread.
+        """
+        import multiprocessing
+
+        self.summary = None
+        self.prepared = False
+        self.error = None
+        self.pool = multiprocessing.Pool(self.processes)
+        self.pending = queue.Queue(maxsize=2 * self.processes)
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def submit(self, support):
+        """
+        Queue a batch of support draws, of dimensions ... x ndays x nparties,
+        e.g. the chains x draws of a sampling round.
+        """
+        support = support.reshape((-1,) + support.shape[-2:])
+        if not self.prepared:
+            _, self.surpluses, self.threshold = self.election.prepare_trace_bader_ofer(
+                support[:0], self.surpluses, self.threshold)
+            self.prepared = True
+        if self.summary is None:
+            self.summary = summary.StreamingForecastSummary(support.shape[1], support.shape[2],
+                int(np.max(self.num_seats)), self.quantiles)
+        result = self.pool.apply_async(israel.compute_bader_ofer,
+            (support, self.surpluses, self.threshold, self.num_seats))
+        self.pending.put((support, result))
+
+    def collect(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            support, result = item
+            try:
+                self.summary.update(support, result.get())
+            except Exception as e:
+                # Keep draining the queue so submit never blocks forever
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.pending.task_done()
+
+    def wait(self):
+        """
+        Wait until all the queued batches are summarized, and return the
+        summary so far (not finalized), e.g. to checkpoint it.
+        """
+        self.pending.join()
+        if self.error is not None:
+            raise self.error
+        return self.summary
+
+    def resume(self, streaming_summary):
+        """
+        Continue the summary returned by wait, e.g. from a checkpoint.
+        Call after start.
+        """
+        self.summary = streaming_summary
+
+    def finish(self):
+        """
+        Wait for all the queued batches, stop the pool and return the
+        summary of all of them.
+        """
+        self.pending.put(None)
+        self.collector.join()
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        if self.error is not None:
+            raise self.error
+        if self.summary is None:
+            raise ValueError('no support batches were submitted')
+        return self.summary.finalize()
+
+    def terminate(self):
+        """
+        Stop the pipeline without waiting for the queued batches.
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self.pending.put(None)
+        self.collector.join()
+
+class StreamingSampler(AdaptiveSampler):
+    """
+    An AdaptiveSampler that hands the support draws of each round to a
+    SeatsPipeline, so the seats and the summary are computed while it
+    samples. After sample(), self.summary holds the ForecastSummary of all
+    the draws; its seats are ordered by round rather than by chain.
+
+    The support of each draw is computed from the chain's point and only
+    kept until its round is submitted, so by default only the election-day
+    support is kept in the trace. Pass varnames to keep other variables.
+    Checkpoints include the summary of the draws so far.
+
+    Example usage:
+        sampler = StreamingSampler(election, varnames=[])
+        samples = sampler.sample()
+        election.plot_mandates(forecast_summary=sampler.summary)
+    """
+    def __init__(self, model, pipeline=None, varnames=(), **kwargs):
+        super(StreamingSampler, self).__init__(model, varnames=varnames, **kwargs)
+        if pipeline is None:
+            pipeline = SeatsPipeline(model, threshold=self.threshold)
+        self.pipeline = pipeline
+        self.summary = None
+        with model:
+            self.compute_support = model.fastfn(model.support)
+        self.round_support = None
+
+    def step_chain(self, chain):
+        super(StreamingSampler, self).step_chain(chain)
+        if len(self.straces[chain]) > self.tune:
+            if self.round_support is None:
+                self.round_support = [ [] for _ in range(self.chains) ]
+            self.round_support[chain] += [ self.compute_support(self.points[chain]) ]
+
+    def on_round(self, new_election_day):
+        self.pipeline.submit(np.asarray(self.round_support))
+        self.round_support = None
+
+    def create_checkpoint(self):
+        checkpoint = super(StreamingSampler, self).create_checkpoint()
+        checkpoint['summary'] = self.pipeline.wait()
+        return checkpoint
+
+    def resume_chains(self, checkpoint):
+        super(StreamingSampler, self).resume_chains(checkpoint)
+        self.pipeline.resume(checkpoint['summary'])
+
+    def sample(self):
+        self.pipeline.start()
+        try:
+            trace = super(StreamingSampler, self).sample()
+        except BaseException:
+            self.pipeline.terminate()
+            raise
+        self.summary = self.pipeline.finish()
+        return trace
+
+def compute_importance_weights(log_weights):
+    """
+    Normalize log importance weights. Returns the weights and their
+    effective sample size.
+    """
+    weights = np.exp(log_weights - np.max(log_weights))
+    weights /= weights.sum()
+    return weights, 1 / (weights ** 2).sum()
+
+def systematic_resample(weights, num_samples=None, random_seed=None):
+    """
+    Systematic resampling of normalized weights: a single uniform offset
+    places num_samples evenly spaced points on the cumulative weights.
+    Returns the indices of the selected samples.
+    """
+    if num_samples is None:
+        num_samples = len(weights)
+    positions = (np.random.RandomState(random_seed).uniform() + np.arange(num_samples)) / num_samples
+    cumulative_weights = np.cumsum(weights)
+    cumulative_weights[-1] = 1
+    return np.searchsorted(cumulative_weights, positions, side='right')
+
+def update_posterior(model, samples, polls, refit=None, min_ess=0.1, log_weights=None,
+                     random_seed=None):
+    """
+    Update the posterior samples of an ElectionForecastModel with new polls
+    without sampling again. Each sample is weighted by the likelihood of
+    the new polls, and the samples are then systematically resampled by
+    their weights.
+
+    samples may be a trace or a dict of the model variables. polls are
+    Poll objects within the modeled days, e.g. as returned by
+    ElectionPolls.add_polls for the new rows.
+
+    Repeated updates should all weigh the samples of the original
+    posterior, passing the log_weights returned by the previous update,
+    rather than the resampled samples: there is no move step, so
+    resampling those again would keep shrinking the set of distinct
+    samples while the effective sample size of each update looks healthy.
+    The effective sample size is that of the accumulated weights, i.e.
+    of all the polls added since the original posterior.
+
+    Returns the resampled samples, as a dict of the same variables, the
+    accumulated log weights of the samples and their effective sample size. If
+    the effective sample size is below min_ess of the number of samples,
+    the polls moved the posterior too far to be reweighted, and refit is
+    called instead to return the samples of a full refit, which replace
+    the original posterior; the returned log weights are then None.
+    Without refit, a ValueError is raised in that case.
+
+    Example usage:
+        new_polls = election.forecast_model.election_polls.add_polls(new_rows)
+        updated, log_weights, ess = update_posterior(election, samples, new_polls,
+            log_weights=log_weights)
+    """
+    rng = np.random.RandomState(random_seed)
+    dynamics = model.forecast_model.dynamics
+    log_likelihood = dynamics.compute_polls_log_likelihood(samples, polls,
+        random_seed=rng.randint(2 ** 31))
+    log_likelihood = log_likelihood.sum(axis=1)
+    if log_weights is not None:
+        log_likelihood += log_weights
+    weights, ess = compute_importance_weights(log_likelihood)
+
+    if ess < min_ess * len(weights):
+        if refit is None:
+            raise ValueError("effective sample size collapsed to %.1f of %d samples, a full refit is required" %
+                (ess, len(weights)))
+        return refit(), None, ess
+
+    indices = systematic_resample(weights, random_seed=rng.randint(2 ** 31))
+    varnames = samples.varnames if hasattr(samples, 'varnames') else samples.keys()
+    return { name: np.asarray(samples[name])[indices] for name in varnames }, log_likelihood, ess
@@ -0,0 +1,229 @@
+# coding: utf-8
+"""
+A local HTTP service that keeps a forecast model and its posterior in
+memory, and answers seat summary, scenario and new poll requests without
+rebuilding, recompiling or resampling the model.
+
+Endpoints:
+    GET  /summary?day=0     the seats and support summary of the posterior
+    POST /scenarios?day=0   a JSON list of scenarios, as accepted by
+                            compute_scenarios_bader_ofer
+    POST /polls             a JSON list of poll rows, with the columns of
+                            the polls dataset and ISO start dates
+    GET  /metrics           request counts, latencies and queue depth
+"""
+
+import collections
+import concurrent.futures
+import http.server
+import json
+import queue
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from . import sampling
+from . import summary
+
+class ForecastService:
+    """
+    Holds an IsraeliElectionForecastModel, its posterior samples and their
+    forecast summary. Requests are queued and handled one at a time by a
+    worker thread, so the model is never used concurrently.
+
+    New polls update the posterior by importance resampling (see
+    sampling.update_posterior). The original samples are kept along with
+    the accumulated log weights of all the polls added since, and each
+    update resamples them anew. refit is called, with no arguments, if the
+    effective sample size of the accumulated weights collapses, and should
+    return new samples, which then replace the original samples.
+
+    Example usage:
+        service = ForecastService(election, samples)
+        service.serve(port=8000)
+    """
+    def __init__(self, election, samples, refit=None, latency_window=1000):
+        self.election = election
+        self.refit = refit
+        self.party_ids = list(election.forecast_model.party_ids)
+
+        self.jobs = queue.Queue()
+        self.started = time.time()
+        self.metrics_lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=latency_window))
+
+        self.set_samples(samples)
+
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def set_samples(self, samples, posterior=None, log_weights=None):
+        # The summary is computed before any state changes, so a failure
+        # leaves the previous samples in place. Without a posterior that
+        # the samples were resampled from, the samples are the posterior.
+        varnames = samples.varnames if hasattr(samples, 'varnames') else samples.keys()
+        samples = { name: np.asarray(samples[name]) for name in varnames }
+        support = samples[self.election.support.name]
+        forecast_summary = self.election.create_forecast_summary(support)
+        if posterior is None:
+            posterior, log_weights = samples, None
+        self.samples, self.support, self.summary = samples, support, forecast_summary
+        self.posterior, self.log_weights = posterior, log_weights
+
+    def work(self):
+        while True:
+            fn, args, future = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def submit(self, fn, *args):
+        """
+        Queue a call on the worker thread and wait for its result.
+        """
+        future = concurrent.futures.Future()
+        self.jobs.put((fn, args, future))
+        return future.result()
+
+    def record(self, endpoint, latency, failed):
+        with self.metrics_lock:
+            self.requests[endpoint] += 1
+            if failed:
+                self.errors[endpoint] += 1
+            self.latencies[endpoint].append(latency)
+
+    def summarize(self, forecast_summary, day):
+        """
+        The per-party statistics of a ForecastSummary on the given day.
+        """
+        parties = []
+        for party, party_id in enumerate(self.party_ids):
+            statistics = {
+                'party': party_id,
+                'seats_mean': float(forecast_summary.seats_mean[day, party]),
+                'seats_std': float(forecast_summary.seats_std[day, party]),
+                'seats_quantiles': forecast_summary.seats_quantiles[:, day, party].tolist(),
+                'passed_probability': float(forecast_summary.passed_probability[day, party]) }
+            if forecast_summary.support_mean is not None:
+                statistics['support_mean'] = float(forecast_summary.support_mean[day, party])
+                statistics['support_std'] = float(forecast_summary.support_std[day, party])
+            parties += [ statistics ]
+        return {
+            'day': day,
+            'num_samples': forecast_summary.num_samples,
+            'quantiles': forecast_summary.quantiles.tolist(),
+            'parties': parties }
+
+    def get_summary(self, day=0):
+        return self.summarize(self.summary, day)
+
+    def post_scenarios(self, scenarios, day=0):
+        # Only the days up to the requested one are allocated
+        bader_ofer = self.election.compute_scenarios_bader_ofer(self.support[:, :day + 1], scenarios)
+        return [ dict(self.summarize(summary.ForecastSummary(None, scenario_seats[:, day:]), 0),
+                      day=day, scenario=scenario)
+            for scenario, scenario_seats in zip(scenarios, bader_ofer) ]
+
+    def post_polls(self, rows):
+        import pandas as pd
+
+        polls_dataset = pd.DataFrame(rows)
+        polls_dataset['start_date'] = pd.to_datetime(polls_dataset['start_date'])
+        # The polls are only kept once the posterior is updated with them,
+        # so a failed request can be retried
+        election_polls = self.election.forecast_model.election_polls
+        num_polls, num_pollsters = len(election_polls), election_polls.num_pollsters
+        try:
+            new_polls = election_polls.add_polls(polls_dataset)
+            if len(new_polls) == 0:
+                raise ValueError('none of the polls are within the modeled days')
+
+            samples, log_weights, ess = sampling.update_posterior(self.election, self.posterior,
+                new_polls, refit=self.refit, log_weights=self.log_weights)
+            self.set_samples(samples, self.posterior if log_weights is not None else None,
+                log_weights)
+        except Exception:
+            election_polls.truncate(num_polls, num_pollsters)
+            raise
+        return { 'added_polls': len(new_polls), 'ess': float(ess), 'summary': self.get_summary() }
+
+    def get_metrics(self):
+        with self.metrics_lock:
+            latencies = {}
+            for endpoint, values in self.latencies.items():
+                values = np.asarray(values)
+                latencies[endpoint] = {
+                    'mean': float(values.mean()),
+                    'p50': float(np.quantile(values, 0.5)),
+                    'p95': float(np.quantile(values, 0.95)),
+                    'max': float(values.max()) }
+            return {
+                'uptime': time.time() - self.started,
+                'queue_depth': self.jobs.qsize(),
+                'requests': dict(self.requests),
+                'errors': dict(self.errors),
+                'latency': latencies }
+
+    def handle(self, method, path, body):
+        """
+        Dispatch a request, returning its HTTP status and JSON response.
+        """
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        day = int(query['day'][0]) if 'day' in query else 0
+
+        if method == 'GET' and url.path == '/metrics':
+            return 200, self.get_metrics()
+        elif method == 'GET' and url.path == '/summary':
+            return 200, self.submit(self.get_summary, day)
+        elif method == 'POST' and url.path == '/scenarios':
+            return 200, self.submit(self.post_scenarios, json.loads(body), day)
+        elif method == 'POST' and url.path == '/polls':
+            return 200, self.submit(self.post_polls, json.loads(body))
+        else:
+            return 404, { 'error': 'unknown endpoint %s %s' % (method, url.path) }
+
+    def serve(self, host='127.0.0.1', port=8000):
+        """
+        Serve requests until interrupted.
+        """
+        server = http.server.ThreadingHTTPServer((host, port), ForecastRequestHandler)
+        server.service = self
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+class ForecastRequestHandler(http.server.BaseHTTPRequestHandler):
+    def respond(self, method):
+        service = self.server.service
+        started = time.time()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length > 0 else None
+            status, response = service.handle(method, self.path, body)
+        except (ValueError, KeyError, IndexError) as e:
+            status, response = 400, { 'error': str(e) }
+        except Exception as e:
+            status, response = 500, { 'error': str(e) }
+        service.record('%s %s' % (method, urlparse(self.path).path), time.time() - started, status >= 400)
+
+        data = json.dumps(response).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
@@ -0,0 +1,269 @@
+# coding: utf-8
+"""
+Summary statistics of an election forecast, computed once from the
+traces of support and seats and shared by all reports.
+"""
+
+import numpy as np
+
+from . import utils
+
+def compute_seats_histogram(seats, max_seats=None):
+    """
+    Count, for each day and party, the number of samples receiving each
+    number of seats. seats should be of dimensions nsamples x ndays x nparties,
+    and the result is of dimensions ndays x nparties x (max_seats + 1).
+    """
+    num_samples, num_days, num_parties = seats.shape
+    if max_seats is None:
+        max_seats = int(seats.max()) if seats.size > 0 else 0
+    num_bins = max_seats + 1
+
+    offsets = (np.arange(num_days * num_parties, dtype='int64') * num_bins).reshape(num_days, num_parties)
+    histogram = np.bincount((seats + offsets).reshape(-1), minlength=num_days * num_parties * num_bins)
+    return histogram.reshape(num_days, num_parties, num_bins)
+
+class ForecastSummary:
+    """
+    Per-party, per-day statistics of the support and seats of a forecast:
+    means, standard deviations, quantiles, seat histograms and threshold
+    pass probabilities, as well as the representative (medoid) sample.
+
+    support and seats should be of dimensions nsamples x ndays x nparties.
+    support may be None if only the seats are summarized.
+    """
+    def __init__(self, support, seats, quantiles=(0.025, 0.5, 0.975)):
+        self.support = support
+        self.seats = seats
+        self.num_samples, self.num_days, self.num_parties = seats.shape
+        self.quantiles = np.asarray(quantiles)
+
+        if support is not None:
+            self.support_mean = support.mean(axis=0)
+            self.support_std = support.std(axis=0)
+            self.support_quantiles = np.quantile(support, self.quantiles, axis=0)
+        else:
+            self.support_mean = self.support_std = self.support_quantiles = None
+
+        self.seats_histogram = compute_seats_histogram(seats)
+        self.summarize_seats()
+
+        self.representatives = {}
+        self.intervals = {}
+
+    def summarize_seats(self):
+        """
+        Compute the seat statistics from the seats histogram.
+        """
+        seats_values = np.arange(self.seats_histogram.shape[2])
+        seats_probability = self.seats_histogram / self.num_samples
+        self.seats_mean = (seats_probability * seats_values).sum(axis=2)
+        self.seats_std = np.sqrt(np.maximum(
+            (seats_probability * seats_values ** 2).sum(axis=2) - self.seats_mean ** 2, 0))
+
+        # Seats are integers, so their quantiles follow directly from the
+        # cumulative histogram.
+        seats_cdf = seats_probability.cumsum(axis=2)
+        self.seats_quantiles = (seats_cdf[None] < self.quantiles[:, None, None, None]).sum(axis=3)
+
+        self.passed_probability = 1 - seats_probability[:, :, 0]
+
+    def representative_seats(self, day=0):
+        """
+        The seats of the sample whose average distance in seats to the
+        other samples is minimal on the given day.
+        """
+        if day not in self.representatives:
+            medoid = utils.compute_medoid_index(self.seats[:, day])
+            self.representatives[day] = self.seats[medoid, day]
+        return self.representatives[day]
+
+    def seats_intervals(self, alpha=0.95, method='empirical'):
+        """
+        The 2 x ndays x nparties lower and upper bounds of the seats
+        (see utils.compute_intervals), computed once per alpha and method.
+        """
+        return self._intervals('seats', self.seats, alpha, method)
+
+    def support_intervals(self, alpha=0.95, method='empirical'):
+        """
+        The 2 x ndays x nparties lower and upper bounds of the support
+        (see utils.compute_intervals), computed once per alpha and method.
+        """
+        if self.support is None:
+            raise ValueError('the support intervals require the support trace')
+        return self._intervals('support', self.support, alpha, method)
+
+    def _intervals(self, name, values, alpha, method):
+        key = (name, alpha, method)
+        if key not in self.intervals:
+            self.intervals[key] = utils.compute_intervals(values, alpha, method)
+        return self.intervals[key]
+
+    def seats_distribution(self, day, party):
+        """
+        The numbers of seats the party receives in any sample on the given
+        day, and the number of samples receiving each.
+        """
+        counts = self.seats_histogram[day, party]
+        values = np.where(counts > 0)[0]
+        return values, counts[values]
+
+    def to_dataframe(self, party_ids=None):
+        """
+        Export the per-day, per-party statistics as a table.
+        """
+        import pandas as pd
+
+        if party_ids is None:
+            party_ids = range(self.num_parties)
+        days, parties = np.meshgrid(np.arange(self.num_days), np.arange(self.num_parties), indexing='ij')
+        columns = {
+            'day': days.reshape(-1),
+            'party': np.asarray(party_ids)[parties.reshape(-1)],
+            'seats_mean': self.seats_mean.reshape(-1),
+            'seats_std': self.seats_std.reshape(-1),
+            'passed_probability': self.passed_probability.reshape(-1) }
+        for q, quantile in zip(self.quantiles, self.seats_quantiles):
+            columns['seats_q%g' % (100 * q)] = quantile.reshape(-1)
+        if self.support_mean is not None:
+            columns['support_mean'] = self.support_mean.reshape(-1)
+            columns['support_std'] = self.support_std.reshape(-1)
+        if self.support_quantiles is not None:
+            for q, quantile in zip(self.quantiles, self.support_quantiles):
+                columns['support_q%g' % (100 * q)] = quantile.reshape(-1)
+        return pd.DataFrame(columns)
+
+class StreamingForecastSummary(ForecastSummary):
+    """
+    A ForecastSummary accumulated from batches of samples, so the support
+    trace never has to be held in full. Only the seats are kept, for the
+    representative sample and the intervals; the support quantiles and
+    intervals are not available.
+
+    Call update with each batch of support and seats, of dimensions
+    nsamples x ndays x nparties, and finalize after the last batch. The
+    support may be None, and the support statistics are then None too,
+    unless every batch had its support.
+    """
+    def __init__(self, num_days, num_parties, max_seats, quantiles=(0.025, 0.5, 0.975)):
+        self.support = None
+        self.seats = None
+        self.num_samples = 0
+        self.num_days = num_days
+        self.num_parties = num_parties
+        self.max_seats = max_seats
+        self.quantiles = np.asarray(quantiles)
+
+        self.support_mean = self.support_std = self.support_quantiles = None
+        self.num_support_samples = 0
+        self.running_mean = np.zeros((num_days, num_parties))
+        self.running_squares = np.zeros((num_days, num_parties))
+        self.seats_histogram = np.zeros((num_days, num_parties, max_seats + 1), dtype='int64')
+        self.seats_batches = []
+
+        self.representatives = {}
+        self.intervals = {}
+
+    def update(self, support, seats):
+        """
+        Add a batch of samples to the summary.
+        """
+        num_samples = len(seats)
+        if num_samples == 0:
+            return
+        total_samples = self.num_samples + num_samples
+
+        # Merge the batch mean and sum of squared deviations into the
+        # running ones, which is stable where the raw sums of squares are not
+        if support is not None:
+            total_support_samples = self.num_support_samples + num_samples
+            batch_mean = support.mean(axis=0)
+            delta = batch_mean - self.running_mean
+            self.running_mean += delta * (num_samples / total_support_samples)
+            self.running_squares += (((support - batch_mean) ** 2).sum(axis=0) +
+                delta ** 2 * (self.num_support_samples * num_samples / total_support_samples))
+            self.num_support_samples = total_support_samples
+
+        self.seats_histogram += compute_seats_histogram(seats, self.max_seats)
+        self.seats_batches += [ seats ]
+        self.num_samples = total_samples
+
+    def finalize(self):
+        """
+        Compute the statistics of all the batches added so far. Returns the
+        summary itself.
+        """
+        self.seats = np.concatenate(self.seats_batches)
+        self.seats_batches = [ self.seats ]
+        if self.num_support_samples > 0 and self.num_support_samples == self.num_samples:
+            self.support_mean = self.running_mean.copy()
+            self.support_std = np.sqrt(self.running_squares / self.num_samples)
+        else:
+            self.support_mean = self.support_std = None
+        self.summarize_seats()
+
+        self.representatives = {}
+        self.intervals = {}
+        return self
+
+class SupportEvolution:
+    """
+    Every per-day series of the support evolution graphs, prepared in one
+    pass from a ForecastSummary: the support and seat means and their
+    bands of z standard deviations, the threshold, the threshold pass
+    probabilities and the days each party exists on.
+
+    dates are the ndays dates of the days. created_days are the day
+    indices (counting back from the forecast day) of the creation of each
+    party, or num_days if it is not created within the days; a party
+    exists on the days after its creation. Dissolutions are not masked,
+    as dissolved parties are removed from the model (see
+    models.read_cycle).
+    """
+    def __init__(self, forecast_summary, dates, threshold, created_days=None, z=1.95996):
+        if forecast_summary.support_mean is None:
+            raise ValueError('the support evolution requires the support trace')
+        num_days, num_parties = forecast_summary.num_days, forecast_summary.num_parties
+        self.dates = np.asarray(dates, dtype='datetime64[D]')
+        self.z = z
+
+        # Parties are ordered by their forecast seats
+        self.party_order = forecast_summary.seats_mean[0].argsort()[::-1]
+
+        self.support_mean = forecast_summary.support_mean
+        self.support_lower = self.support_mean - z * forecast_summary.support_std
+        self.support_upper = self.support_mean + z * forecast_summary.support_std
+        self.seats_mean = forecast_summary.seats_mean
+        self.seats_lower = self.seats_mean - z * forecast_summary.seats_std
+        self.seats_upper = self.seats_mean + z * forecast_summary.seats_std
+        self.thresholds = np.broadcast_to(np.asarray(threshold, dtype='float64'), (num_days,))
+        self.passed_probability = forecast_summary.passed_probability
+
+        if created_days is None:
+            created_days = np.full(num_parties, num_days)
+        self.active = np.arange(num_days)[:, None] < np.asarray(created_days)
+
+    def to_dataframe(self, party_ids=None):
+        """
+        Export the series as a table with a row per day and party, for the
+        days each party exists on.
+        """
+        import pandas as pd
+
+        num_days, num_parties = self.active.shape
+        if party_ids is None:
+            party_ids = range(num_parties)
+        days, parties = np.nonzero(self.active)
+        return pd.DataFrame({
+            'day': days,
+            'date': self.dates[days],
+            'party': np.asarray(party_ids)[parties],
+            'support_mean': self.support_mean[days, parties].astype('float32'),
+            'support_lower': self.support_lower[days, parties].astype('float32'),
+            'support_upper': self.support_upper[days, parties].astype('float32'),
+            'seats_mean': self.seats_mean[days, parties].astype('float32'),
+            'seats_lower': self.seats_lower[days, parties].astype('float32'),
+            'seats_upper': self.seats_upper[days, parties].astype('float32'),
+            'threshold': self.thresholds[days].astype('float32'),
+            'passed_probability': self.passed_probability[days, parties].astype('float32') })
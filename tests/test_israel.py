@@ -0,0 +1,67 @@
+# coding: utf-8
+"""
+Tests of the Israeli election seat computations.
+"""
+
+import functools
+import types
+
+import numpy as np
+import pytest
+
+from .. import israel
+from .. import summary
+
+def create_support_trace(num_samples=2000, num_days=3, random_seed=1):
+    # Parties around the threshold, and a pair with a surplus agreement
+    mean = np.array([0.3, 0.2, 0.15, 0.12, 0.1, 0.06, 0.035, 0.035])
+    rng = np.random.RandomState(random_seed)
+    return rng.dirichlet(mean * 2000, size=[num_samples, num_days])
+
+def test_float32_seat_probabilities_drift():
+    trace = create_support_trace()
+    surplus_regimes = [ (0, trace.shape[1], np.array([[0, 1], [4, 5]])) ]
+    threshold = 0.0325
+
+    reference = israel.compute_bader_ofer(trace.astype('float64'), surplus_regimes, threshold)
+    bader_ofer = israel.compute_bader_ofer(trace.astype('float32'), surplus_regimes, threshold)
+
+    assert bader_ofer.dtype == reference.dtype
+    assert (bader_ofer.sum(axis=-1) == israel.KNESSET_SEATS).all()
+    num_samples = len(trace)
+    drift = np.abs(summary.compute_seats_histogram(bader_ofer, israel.KNESSET_SEATS) -
+                   summary.compute_seats_histogram(reference, israel.KNESSET_SEATS)).max() / num_samples
+    assert drift <= 0.005
+    assert (bader_ofer != reference).any(axis=(1, 2)).mean() <= 0.01
+
+def create_scenario_election(party_ids, surplus_agreements, num_days=3):
+    # Only the configuration of the forecast model is needed for the
+    # surplus regimes
+    election = types.SimpleNamespace(forecast_model=types.SimpleNamespace(
+        party_ids=party_ids, num_parties=len(party_ids), num_days=num_days,
+        config={ 'surplus_agreements': surplus_agreements }))
+    election.create_surplus_regimes = functools.partial(
+        israel.IsraeliElectionForecastModel.create_surplus_regimes, election)
+    return election
+
+def create_scenario_surplus_regimes(election, scenario):
+    return israel.IsraeliElectionForecastModel.create_scenario_surplus_regimes(election, scenario)
+
+def test_merged_parties_keep_a_single_agreement():
+    election = create_scenario_election(['a', 'b', 'c', 'd'],
+        [ { 'name1': 'a', 'name2': 'c' }, { 'name1': 'b', 'name2': 'd' } ])
+
+    # Both merged parties had agreements
+    with pytest.raises(ValueError):
+        create_scenario_surplus_regimes(election, { 'mergers': [['a', 'b']] })
+
+    # Dropping one of them resolves the conflict
+    [(first_day, last_day, pairs)] = create_scenario_surplus_regimes(election,
+        { 'mergers': [['a', 'b']], 'drop_surplus_agreements': [('b', 'd')] })
+    assert (first_day, last_day) == (0, 3)
+    assert pairs.tolist() == [[0, 2]]
+
+    # An agreement between the merged parties is dropped
+    election = create_scenario_election(['a', 'b', 'c'], [ { 'name1': 'a', 'name2': 'b' } ])
+    [(_, _, pairs)] = create_scenario_surplus_regimes(election, { 'mergers': [['a', 'b']] })
+    assert len(pairs) == 0
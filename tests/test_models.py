@@ -0,0 +1,50 @@
+# coding: utf-8
+"""
+Tests of the election models on small sets of polls.
+"""
+
+import datetime
+
+import pandas as pd
+import pymc3 as pm
+
+from .. import configuration
+from .. import models
+from .. import polls
+
+def create_polls_dataset(pollster, percentages):
+    start_dates = pd.to_datetime(['2019-09-%02d' % day for day in range(10, 17)])
+    return pd.DataFrame({ 'pollster': pollster, 'start_date': start_dates, 'num_days': 1,
+        'num_polled': 500, 'a': percentages[0], 'b': percentages[1] })
+
+def find_election_day_votes(weights):
+    election_polls = polls.ElectionPolls(
+        [ create_polls_dataset('x', [0.6, 0.4]), create_polls_dataset('y', [0.4, 0.6]) ],
+        ['a', 'b'], datetime.date(2019, 9, 17), weights=weights)
+    with pm.Model() as model:
+        cholesky_pmatrix = pm.LKJCholeskyCov('cholesky_pmatrix', n=2, eta=1,
+            sd_dist=pm.HalfCauchy.dist(0.1, shape=[2]))
+        cholesky_matrix = pm.expand_packed_triangular(2, cholesky_pmatrix)
+        votes = pm.Flat('votes', shape=2)
+        models.ElectionDynamicsModel('dynamics', votes, election_polls, [0, 1], cholesky_matrix,
+            test_results=None, house_effects_model='raw-polls', min_polls_per_pollster=1,
+            adjacent_day_fn=-2.)
+        return pm.find_MAP(progressbar=False)[votes.name]
+
+def test_series_weights_move_the_posterior():
+    unweighted = find_election_day_votes([1., 1.])
+    weighted = find_election_day_votes([4., 1.])
+    assert abs(unweighted[0] - 0.5) < 0.02
+    assert weighted[0] > unweighted[0] + 0.03
+
+def test_single_series_keeps_all_its_rows(tmp_path):
+    # Two of the pollster's polls on the same day, e.g. for two outlets
+    filename = str(tmp_path / 'polls.csv')
+    pd.DataFrame({ 'id': [1, 2, 3], 'pollster': ['x', 'x', 'y'],
+        'start_date': ['2019-09-10', '2019-09-10', '2019-09-11'], 'num_days': 1,
+        'num_polled': 500, 'p_a': [60, 66, 54], 'p_b': [60, 54, 66] }).to_csv(filename, index=False)
+    config = configuration.Configuration({ 'cycles': { '22': {
+        'election_day': '17/09/2019', 'parties': { 'p_a': {}, 'p_b': {} },
+        'polls': [ { 'type': 'csv', 'filename': filename } ] } } })
+    _, _, election_polls, _ = models.read_cycle(config, '22', None, 0, None, None, None)
+    assert len(election_polls) == 3
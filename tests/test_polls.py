@@ -0,0 +1,37 @@
+# coding: utf-8
+"""
+Tests of merging poll series.
+"""
+
+import datetime
+
+import pandas as pd
+
+from .. import polls
+
+def create_polls_dataset(pollsters, days, percentage):
+    return pd.DataFrame({ 'pollster': pollsters,
+        'start_date': pd.to_datetime(['2019-09-%02d' % day for day in days]),
+        'num_days': 1, 'num_polled': 500, 'a': percentage, 'b': 1 - percentage })
+
+def test_single_series_keeps_same_day_polls():
+    # A pollster's polls for two outlets on the same day
+    dataset = create_polls_dataset(['x', 'x', 'y'], [10, 10, 10], 0.6)
+    merged = polls.merge_polls_datasets([ dataset ], [ 2. ])
+    assert len(merged) == 3
+    assert (merged['weight'] == 2.).all()
+
+    election_polls = polls.ElectionPolls([ dataset ], ['a', 'b'], datetime.date(2019, 9, 17))
+    assert len(election_polls) == 3
+
+def test_polls_in_several_series_are_kept_once():
+    first = create_polls_dataset(['x', 'x', 'y'], [10, 10, 11], 0.6)
+    second = create_polls_dataset(['x', 'y', 'z'], [10, 12, 12], 0.4)
+    merged = polls.merge_polls_datasets([ first, second ], [ 1., 2. ])
+    # Both of x's polls on the 10th are in the lower weighted first series
+    # and are dropped for the second series' poll
+    assert len(merged) == 4
+    assert sorted(zip(merged['pollster'], merged['source'])) == [
+        ('x', 1), ('y', 0), ('y', 1), ('z', 1) ]
+    x_polls = merged[merged['pollster'] == 'x']
+    assert (x_polls['weight'] == 2.).all()
@@ -0,0 +1,49 @@
+# coding: utf-8
+"""
+Tests of the sampling drivers on a small model.
+"""
+
+import pickle
+
+import numpy as np
+import pymc3 as pm
+import theano.tensor as tt
+
+from .. import sampling
+
+def create_model():
+    with pm.Model() as model:
+        votes = pm.Normal('votes', 0.3, 0.05, shape=3)
+        model.support = pm.Deterministic('support', tt.stack([votes, votes]))
+        model.election_day_support = pm.Deterministic('election_day_support', model.support[0])
+    return model
+
+def create_sampler(model, path):
+    return sampling.AdaptiveSampler(model, chains=2, tune=100, draws_per_round=50,
+        min_draws=100, max_draws=200, threshold=0.1, random_seed=1, checkpoint_path=path)
+
+def test_resume_from_checkpoint(tmp_path):
+    path = str(tmp_path / 'checkpoint.pickle')
+    model = create_model()
+    sampler = create_sampler(model, path)
+    sampler.start_chains()
+    sampler.advance(50)
+    sampler.save_checkpoint()
+
+    resumed = create_sampler(model, path)
+    with open(path, 'rb') as f:
+        resumed.resume_chains(pickle.load(f))
+    for step, resumed_step in zip(sampler.steps, resumed.steps):
+        assert resumed_step.step_size == step.step_size
+        np.testing.assert_array_equal(resumed_step.potential._var, step.potential._var)
+        assert not resumed_step.tune
+    assert [ len(strace) for strace in resumed.straces ] == [ 150, 150 ]
+
+    # The resumed chains neither tune again nor restart their traces
+    step_sizes = [ step.step_size for step in resumed.steps ]
+    resumed.advance(50)
+    assert [ step.step_size for step in resumed.steps ] == step_sizes
+    election_day = resumed.get_election_day_support()
+    assert election_day.shape == (2, 100, 3)
+    np.testing.assert_array_equal(election_day[:, :50], sampler.get_election_day_support())
+    assert len(resumed.get_trace()) == 100
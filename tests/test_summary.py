@@ -0,0 +1,35 @@
+# coding: utf-8
+"""
+Tests of the forecast summaries.
+"""
+
+import numpy as np
+
+from .. import summary
+
+def create_trace(num_samples=300, num_days=4, num_parties=3, random_seed=1):
+    rng = np.random.RandomState(random_seed)
+    support = rng.dirichlet([30, 20, 10], size=[num_samples, num_days])
+    seats = rng.randint(0, 60, size=[num_samples, num_days, num_parties]).astype('uint8')
+    return support, seats
+
+def test_streaming_summary_matches_summary():
+    support, seats = create_trace()
+    streaming = summary.StreamingForecastSummary(support.shape[1], support.shape[2], 120)
+    for start in range(0, len(support), 70):
+        streaming.update(support[start:start + 70], seats[start:start + 70])
+    streaming.finalize()
+
+    forecast_summary = summary.ForecastSummary(support, seats)
+    assert np.allclose(streaming.support_mean, forecast_summary.support_mean)
+    assert np.allclose(streaming.support_std, forecast_summary.support_std)
+    assert np.allclose(streaming.seats_mean, forecast_summary.seats_mean)
+
+def test_streaming_summary_without_support():
+    _, seats = create_trace()
+    streaming = summary.StreamingForecastSummary(seats.shape[1], seats.shape[2], 120)
+    streaming.update(None, seats)
+    streaming.finalize()
+
+    assert streaming.support_mean is None and streaming.support_std is None
+    assert 'support_mean' not in streaming.to_dataframe().columns
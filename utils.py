@@ -1,5 +1,3 @@
-import theano
-import theano.tensor as T
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -7,16 +5,169 @@ import seaborn as sns
 def get_version():
     return 2
 
-def compute_correlations(cholesky_matrices): #samples['election21_2019_cholesky_matrix',-1000:]
-    chol_array = T.tensor3('chol_array', dtype='float64')
-    def compute_corr(chol):
-      cov=T.dot(chol, chol.T)
-      sd=T.sqrt(T.diag(cov))
-      sd_1=T.diag(sd**-1)
-      return T.nlinalg.matrix_dot(sd_1, cov, sd_1)
-    chol_array_out,_= theano.scan(compute_corr, sequences=[chol_array])
-    dot_chol_array = theano.function(inputs=[chol_array], outputs=chol_array_out)
-    return dot_chol_array(cholesky_matrices)
+def compute_correlations(cholesky_matrices, chunk_size=10000, packed=False): #samples['election21_2019_cholesky_matrix',-1000:]
+    """
+    Compute the correlation matrices of samples x nparties x nparties
+    cholesky factors, in chunks of chunk_size samples.
+    
+    If packed is True, only the lower triangle below the diagonal of each
+    correlation matrix is returned, as samples x nparties * (nparties - 1) / 2,
+    ordered as numpy.tril_indices(nparties, -1).
+    """
+    cholesky_matrices = np.asarray(cholesky_matrices)
+    num_samples, num_parties, _ = cholesky_matrices.shape
+    if packed:
+        rows, cols = np.tril_indices(num_parties, -1)
+        correlations = np.empty([num_samples, len(rows)])
+    else:
+        correlations = np.empty([num_samples, num_parties, num_parties])
+
+    for start in range(0, num_samples, chunk_size):
+        chol = cholesky_matrices[start:start + chunk_size]
+        cov = np.einsum('sij,skj->sik', chol, chol)
+        sd_1 = 1 / np.sqrt(np.einsum('sii->si', cov))
+        if packed:
+            correlations[start:start + chunk_size] = cov[:, rows, cols] * sd_1[:, rows] * sd_1[:, cols]
+        else:
+            correlations[start:start + chunk_size] = cov * sd_1[:, :, None] * sd_1[:, None, :]
+    return correlations
+
+def unpack_correlations(packed_correlations, num_parties):
+    """
+    Expand correlations packed by compute_correlations into full
+    samples x nparties x nparties matrices.
+    """
+    rows, cols = np.tril_indices(num_parties, -1)
+    correlations = np.empty([len(packed_correlations), num_parties, num_parties])
+    correlations[:, rows, cols] = packed_correlations
+    correlations[:, cols, rows] = packed_correlations
+    correlations[:, np.arange(num_parties), np.arange(num_parties)] = 1
+    return correlations
+
+def compute_intervals(values, alpha=0.95, method='empirical', axis=0):
+    """
+    Compute the alpha-level intervals of values along the given axis,
+    for all other dimensions at once. Returns an array whose first
+    dimension holds the lower and upper bounds.
+    
+    method may be 'empirical', for the equal-tailed interval computed
+    with a single partition, or 'hdi', for the narrowest interval
+    containing an alpha fraction of the values, computed with a single sort.
+    """
+    values = np.moveaxis(np.asarray(values), axis, 0)
+    num_values = len(values)
+
+    if method == 'empirical':
+        lower = int(np.floor((1 - alpha) / 2 * (num_values - 1)))
+        upper = int(np.ceil((1 + alpha) / 2 * (num_values - 1)))
+        partitioned = np.partition(values, [lower, upper], axis=0)
+        return np.stack([partitioned[lower], partitioned[upper]])
+    elif method == 'hdi':
+        interval_size = min(num_values, int(np.ceil(alpha * num_values)))
+        sorted_values = np.sort(values, axis=0)
+        widths = sorted_values[interval_size - 1:] - sorted_values[:num_values - interval_size + 1]
+        lower = np.expand_dims(widths.argmin(axis=0), 0)
+        return np.stack([np.take_along_axis(sorted_values, lower, axis=0)[0],
+                         np.take_along_axis(sorted_values, lower + interval_size - 1, axis=0)[0]])
+    else:
+        raise ValueError("expected method '%s' to be one of empirical, hdi" % method)
+
+def compute_medoid_index(points, chunk_size=1000, num_reference_samples=None, random_seed=None):
+    """
+    Find the index of the point whose mean euclidean distance to all points
+    is minimal. points should be of dimensions npoints x ndims.
+    
+    The distances are computed for chunk_size points at a time using
+    |a-b|^2 = |a|^2 + |b|^2 - 2a.b, so memory grows linearly with the
+    number of points. For small integers, such as seats, this is exact.
+    
+    If num_reference_samples is given, the mean distance is instead
+    approximated against a random subset of that many points.
+    """
+    points = np.asarray(points, dtype='float64')
+    num_points = len(points)
+
+    if num_reference_samples is not None and num_reference_samples < num_points:
+        rng = np.random.RandomState(random_seed)
+        reference = points[np.sort(rng.choice(num_points, num_reference_samples, replace=False))]
+    else:
+        reference = points
+    reference_sqr = (reference ** 2).sum(axis=1)
+
+    mean_dists = np.empty(num_points)
+    for start in range(0, num_points, chunk_size):
+        chunk = points[start:start + chunk_size]
+        chunk_sqr = (chunk ** 2).sum(axis=1)
+        sqr_dists = reference_sqr[:, None] + chunk_sqr[None, :] - 2 * reference.dot(chunk.T)
+        mean_dists[start:start + chunk_size] = np.sqrt(np.maximum(sqr_dists, 0)).mean(axis=0)
+    return mean_dists.argmin()
+
+def compute_binned_densities(values, num_bins=None, max_bins=50, bandwidth=None, cut=3, oversample=4):
+    """
+    Compute the histogram and gaussian kernel density estimate of each
+    series of values, for all series at once. values should be of
+    dimensions ... x nvalues.
+    
+    All histograms are computed by a single bincount, and the densities
+    by convolving the histograms with the kernel using an FFT. By default,
+    the number of bins is the largest Freedman-Diaconis number of bins of
+    the series, up to max_bins, and the bandwidth follows Scott's rule.
+    
+    Returns the bin edges (... x nbins + 1), the histogram densities
+    (... x nbins), the density grid (... x ngrid) and the kernel density
+    estimates on the grid (... x ngrid). The grid has oversample points
+    per histogram bin and extends cut bandwidths beyond the values; the
+    estimate is nan outside of that range.
+    """
+    values = np.asarray(values, dtype='float64')
+    series_shape = values.shape[:-1]
+    values = values.reshape(-1, values.shape[-1])
+    num_series, num_values = values.shape
+
+    low = values.min(axis=1)
+    high = values.max(axis=1)
+    if num_bins is None:
+        q25, q75 = np.percentile(values, [25, 75], axis=1)
+        bin_width = 2 * (q75 - q25) / num_values ** (1 / 3)
+        fd_bins = np.where(bin_width > 0,
+            np.ceil((high - low) / np.where(bin_width > 0, bin_width, 1)),
+            np.sqrt(num_values))
+        num_bins = int(min(max_bins, max(1, fd_bins.max())))
+    if bandwidth is None:
+        bandwidth = 1.06 * values.std(axis=1) * num_values ** (-1 / 5)
+    bandwidth = np.broadcast_to(bandwidth, [num_series])
+
+    # Pad the histogram on both sides so the FFT convolution does not wrap
+    # around, and so the density can extend beyond the values.
+    span = np.where(high > low, high - low, 1.)
+    num_fine_bins = num_bins * oversample
+    width = span / num_fine_bins
+    kernel_bins = bandwidth / width
+    pad = int(np.ceil(min(max(cut * kernel_bins.max(), 1), 10 * num_fine_bins)))
+    num_grid = num_fine_bins + 2 * pad
+
+    indices = np.clip(((values - low[:, None]) / width[:, None]).astype('int64'), 0, num_fine_bins - 1)
+    offsets = (np.arange(num_series) * num_grid + pad)[:, None]
+    counts = np.bincount((indices + offsets).reshape(-1),
+        minlength=num_series * num_grid).reshape(num_series, num_grid)
+
+    frequencies = np.fft.rfftfreq(num_grid)
+    kernel = np.exp(-2 * (np.pi * frequencies[None, :] * kernel_bins[:, None]) ** 2)
+    kde = np.fft.irfft(np.fft.rfft(counts, axis=1) * kernel, n=num_grid, axis=1)
+    kde = np.maximum(kde, 0) / (num_values * width[:, None])
+
+    edges = low[:, None] + oversample * width[:, None] * np.arange(num_bins + 1)
+    histogram = (counts[:, pad:pad + num_fine_bins].reshape(num_series, num_bins, oversample).sum(axis=2) /
+        (num_values * oversample * width[:, None]))
+    grid = low[:, None] + width[:, None] * (np.arange(num_grid) - pad + 0.5)
+    outside = ((grid < low[:, None] - cut * bandwidth[:, None]) |
+               (grid > high[:, None] + cut * bandwidth[:, None]))
+    kde[outside] = np.nan
+
+    return (edges.reshape(series_shape + (num_bins + 1,)),
+            histogram.reshape(series_shape + (num_bins,)),
+            grid.reshape(series_shape + (num_grid,)),
+            kde.reshape(series_shape + (num_grid,)))
 
 def plot_correlation_matrix(correlation_matrix, labels, alignRight=False, cmap=None):
     # Generate a mask for the upper triangle
@@ -49,40 +200,36 @@ def plot_correlation_matrix(correlation_matrix, labels, alignRight=False, cmap=N
         ax.invert_xaxis()
 
 def plot_correlation_matrices(correlation_matrices, labels, alignRight=False, cmap=None):
+    """
+    Plot the distributions of the correlations of each pair of parties.
+    correlation_matrices may be full or packed by compute_correlations.
+    """
     import seaborn as sns
-    from seaborn.utils import iqr
     import matplotlib as mpl
     import matplotlib.cm as cm
     import matplotlib.pyplot as plt
     import numpy as np
-    from distutils.version import LooseVersion
     
-    def _freedman_diaconis_bins(a):
-        """Calculate number of hist bins using Freedman-Diaconis rule."""
-        # From https://stats.stackexchange.com/questions/798/
-        a = np.asarray(a)
-        if len(a) < 2:
-            return 1
-        h = 2 * iqr(a) / (len(a) ** (1 / 3))
-        # fall back to sqrt(a) bins if iqr is 0
-        if h == 0:
-            return int(np.sqrt(a.size))
-        else:
-            return int(np.ceil((a.max() - a.min()) / h))
+    # Compute the histograms and densities of all of the plotted
+    # correlations in one call
+    num_labels = len(labels)
+    rows, cols = np.tril_indices(num_labels - 1)
+    pair_index = np.zeros([num_labels - 1, num_labels - 1], dtype='int64')
+    pair_index[rows, cols] = np.arange(len(rows))
+    if correlation_matrices.ndim == 2:
+        # Packed by compute_correlations, in the same order
+        correlations_t = correlation_matrices.T
+    else:
+        correlations_t = correlation_matrices[:, rows + 1, cols].T
+    edges, histograms, grids, densities = compute_binned_densities(correlations_t)
+    correlations_mean = correlations_t.mean(axis=1)
     
-    corr_t = correlation_matrices.transpose(1,2,0)
     if cmap is None:
         cmap = sns.diverging_palette(10, 150, s=80, as_cmap=True)
 
     f, ax = plt.subplots(len(labels) - 1, len(labels) - 1, figsize=(11, 9))
     norm = mpl.colors.Normalize(vmin=-0.3,vmax=0.3)
     m = cm.ScalarMappable(norm=norm, cmap=cmap)
-    hist_kws = {}
-    norm_hist = True
-    if LooseVersion(mpl.__version__) < LooseVersion("2.2"):
-        hist_kws.setdefault("normed", norm_hist)
-    else:
-        hist_kws.setdefault("density", norm_hist)
 
     xlabels = labels[:-1]
     if alignRight:
@@ -107,14 +254,13 @@ def plot_correlation_matrices(correlation_matrices, labels, alignRight=False, cm
               right=False, labelright=False)
           subplot.grid(False)
           if xindex <= yindex:
-            correlations = corr_t[yindex + 1][xindex]
-            nbins = min(_freedman_diaconis_bins(correlations), 50)
-            n, bins, patches = subplot.hist(correlations, nbins, **hist_kws)
-            for i,p in enumerate(patches):
-              p.set_facecolor(m.to_rgba(np.mean((bins[i], bins[i+1]))))
+            pair = pair_index[yindex, xindex]
+            bins = edges[pair]
+            subplot.bar(bins[:-1], histograms[pair], width=np.diff(bins), align='edge',
+                        color=m.to_rgba((bins[:-1] + bins[1:]) / 2))
     
-            subplot.set_facecolor(m.to_rgba(correlations.mean()))
-            sns.kdeplot(correlations, ax=subplot, color='w', linewidth=1)
+            subplot.set_facecolor(m.to_rgba(correlations_mean[pair]))
+            subplot.plot(grids[pair], densities[pair], color='w', linewidth=1)
     
     m.set_array([])
     